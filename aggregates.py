@@ -0,0 +1,85 @@
+"""
+Precomputed aggregate texts.
+
+Instructor and course texts list the courses or instructors linked through
+course_instructors. Instead of aggregating that join for every candidate row,
+the aggregated column is kept per row in a table in the vectors schema:
+- change detection triggers delete the rows whose links changed (see
+  change_tracking.py);
+- refresh_aggregates recomputes only the rows missing from the table, so after
+  the first fill a refresh costs as much as the links that changed.
+The candidate queries then read the aggregate with a plain join on the id.
+"""
+from config import EMBEDDING_CONFIG, logger
+from entities import ENTITIES
+
+def ensure_aggregate_tables(conn):
+    """Create the aggregate tables of the entity types that have one."""
+    cursor = conn.cursor()
+    
+    try:
+        for spec in ENTITIES.values():
+            if spec.aggregate is None:
+                continue
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {spec.aggregate_table} (
+                    {spec.id_column} INTEGER PRIMARY KEY,
+                    {spec.aggregate.column} TEXT,
+                    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+        conn.commit()
+        logger.info("Aggregate tables are ready")
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error creating aggregate tables: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def refresh_aggregates(conn, spec, id_range=None):
+    """
+    Compute the aggregate column of the rows missing from the aggregate table.
+    
+    id_range limits the refresh to an (exclusive lower, inclusive upper) id
+    range, so sharded workers each refresh their own rows. Returns the number
+    of rows refreshed.
+    """
+    if spec.aggregate is None:
+        return 0
+    
+    cursor = conn.cursor()
+    schema = EMBEDDING_CONFIG['schema']['source']
+    a = spec.alias
+    last_id, max_id = id_range or (None, None)
+    
+    try:
+        cursor.execute(f"""
+            INSERT INTO {spec.aggregate_table} ({spec.id_column}, {spec.aggregate.column})
+            SELECT {a}.id, {spec.aggregate.expression}
+            FROM {spec.source} {a}
+            {spec.aggregate.joins.format(source=schema)}
+            WHERE NOT EXISTS (SELECT 1 FROM {spec.aggregate_table} agg WHERE agg.{spec.id_column} = {a}.id)
+              AND (%(last_id)s IS NULL OR {a}.id > %(last_id)s)
+              AND (%(max_id)s IS NULL OR {a}.id <= %(max_id)s)
+            GROUP BY {a}.id
+            ON CONFLICT ({spec.id_column}) DO UPDATE
+            SET {spec.aggregate.column} = EXCLUDED.{spec.aggregate.column},
+                refreshed_at = CURRENT_TIMESTAMP;
+        """, {'last_id': last_id, 'max_id': max_id})
+        
+        refreshed = cursor.rowcount
+        conn.commit()
+        if refreshed:
+            logger.info(f"Refreshed {refreshed} {spec.name} aggregates")
+        return refreshed
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error refreshing {spec.name} aggregates: {e}")
+        raise
+    
+    finally:
+        cursor.close()
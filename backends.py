@@ -0,0 +1,212 @@
+"""
+Inference backends for the embedding model.
+
+The backend is selected with EMBEDDING_CONFIG['backend']:
+- torch: fp32 PyTorch inference (default)
+- onnx: ONNX Runtime inference of the exported model
+- onnx-int8: ONNX Runtime inference of a dynamically int8-quantized model
+
+All backends return a SentenceTransformer, so the model is a drop-in
+replacement wherever a model is passed to the generators.
+
+sentence-transformers and torch are only imported when a model is loaded. With
+MODEL_PATH set, the model is read from that local directory (the Docker image
+bakes one in) without any hub lookups. The directory records the model it was
+saved from in MODEL_IDENTITY_FILE.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+from config import EMBEDDING_CONFIG, logger
+from entities import ENTITIES
+from metrics import METRICS, PROCESS_START
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+# Minimum cosine similarity to the torch backend expected for every sampled text
+AGREEMENT_THRESHOLD = 0.99
+
+# Name, revision and dimension of a saved model, written next to it at build time
+MODEL_IDENTITY_FILE = 'model_identity.json'
+
+def _quantized_model_path():
+    """Local directory holding the exported model and its quantized ONNX file."""
+    return os.path.join(EMBEDDING_CONFIG['onnx_model_dir'], EMBEDDING_CONFIG['model_name'].replace('/', '_'))
+
+def _model_source():
+    """Name or path of the model, and the loading options that go with it."""
+    if EMBEDDING_CONFIG['model_path']:
+        return EMBEDDING_CONFIG['model_path'], {'local_files_only': True}
+    if EMBEDDING_CONFIG['model_revision']:
+        return EMBEDDING_CONFIG['model_name'], {'revision': EMBEDDING_CONFIG['model_revision']}
+    return EMBEDDING_CONFIG['model_name'], {}
+
+@functools.lru_cache(maxsize=None)
+def model_identity():
+    """
+    Name, revision and dimension of the model that is loaded.
+    
+    A local model directory is identified by its MODEL_IDENTITY_FILE, not by
+    the configuration, and must match the configured model and dimension. The
+    file is read once per process.
+    """
+    name = EMBEDDING_CONFIG['model_name']
+    revision = EMBEDDING_CONFIG['model_revision']
+    dim = EMBEDDING_CONFIG['embedding_dim']
+    path = EMBEDDING_CONFIG['model_path']
+    if not path:
+        return name, revision, dim
+    
+    identity_path = os.path.join(path, MODEL_IDENTITY_FILE)
+    if not os.path.exists(identity_path):
+        raise ValueError(f"{path} has no {MODEL_IDENTITY_FILE} naming the model it holds")
+    with open(identity_path) as f:
+        identity = json.load(f)
+    
+    # Embeddings must never be labelled with a model that did not compute them
+    if identity['name'] != name or (revision and identity['revision'] != revision):
+        raise ValueError(f"{path} holds {identity['name']}@{identity['revision']}, not the configured "
+                         f"{name}{f'@{revision}' if revision else ''}; build an image with that model "
+                         f"or unset MODEL_PATH")
+    if identity['dimension'] != dim:
+        raise ValueError(f"{path} holds a model of dimension {identity['dimension']}, but EMBEDDING_DIM is {dim}")
+    return identity['name'], identity['revision'], identity['dimension']
+
+def model_version():
+    """Identifier of the loaded model and its dimension, recorded with every embedding."""
+    name, revision, dim = model_identity()
+    version = f"{name}@{revision}" if revision else name
+    return f"{version}/{dim}"
+
+def warm_up(model):
+    """Encode a dummy batch so the first real batch does not pay for lazy initialisation."""
+    model.encode(['warm-up'] * EMBEDDING_CONFIG['batch_size'],
+                 batch_size=EMBEDDING_CONFIG['batch_size'], show_progress_bar=False)
+
+def load_model(backend=None):
+    """Load the embedding model with the configured (or given) backend."""
+    backend = backend or EMBEDDING_CONFIG['backend']
+    version = model_version()
+    start = time.perf_counter()
+    model = _load_model(backend)
+    
+    dim = model.get_sentence_embedding_dimension()
+    if dim != EMBEDDING_CONFIG['embedding_dim']:
+        raise ValueError(f"Model {version} produces {dim}-dimensional embeddings, "
+                         f"but EMBEDDING_DIM is {EMBEDDING_CONFIG['embedding_dim']}")
+    
+    # Make truncation explicit: texts longer than this many tokens are cut off
+    if EMBEDDING_CONFIG['max_seq_length']:
+        model.max_seq_length = EMBEDDING_CONFIG['max_seq_length']
+    loaded = time.perf_counter() - start
+    METRICS.set_gauge('model_load_seconds', loaded)
+    logger.info(f"Model {version} loaded with {backend} backend in {loaded:.2f}s "
+                f"(max_seq_length {model.max_seq_length} tokens)")
+    
+    if EMBEDDING_CONFIG['warm_up']:
+        warm_up(model)
+        first_embedding = time.perf_counter() - PROCESS_START
+        METRICS.set_gauge('time_to_first_embedding_seconds', first_embedding)
+        logger.info(f"Model warmed up; first embedding {first_embedding:.2f}s after start")
+    return model
+
+class LazyModel:
+    """
+    Stand-in for the model that loads it on first use.
+    
+    Runs that find nothing to encode, and parent processes whose workers load
+    their own model, never import torch or read the model files.
+    """
+    
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._model = None
+        self._lock = threading.Lock()
+    
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                self._model = load_model(self._backend)
+        return self._model
+    
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+def _load_model(backend=None):
+    """Instantiate the SentenceTransformer for a backend."""
+    from sentence_transformers import SentenceTransformer
+    
+    model_name, options = _model_source()
+    
+    if backend == 'torch':
+        return SentenceTransformer(model_name, **options)
+    
+    if backend == 'onnx':
+        return SentenceTransformer(model_name, backend='onnx', **options)
+    
+    if backend == 'onnx-int8':
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        
+        quantization = EMBEDDING_CONFIG['onnx_quantization']
+        model_path = _quantized_model_path()
+        file_name = f"onnx/model_qint8_{quantization}.onnx"
+        
+        # The Docker image bakes the quantized model next to the saved one
+        if EMBEDDING_CONFIG['model_path'] and os.path.exists(os.path.join(model_name, file_name)):
+            return SentenceTransformer(model_name, backend='onnx', model_kwargs={'file_name': file_name}, **options)
+        
+        # Export and quantize once, then reuse the local artifact
+        if not os.path.exists(os.path.join(model_path, file_name)):
+            logger.info(f"Exporting {model_name} to ONNX with {quantization} int8 quantization")
+            model = SentenceTransformer(model_name, backend='onnx', **options)
+            model.save(model_path)
+            export_dynamic_quantized_onnx_model(model, quantization, model_path)
+        
+        return SentenceTransformer(model_path, backend='onnx', model_kwargs={'file_name': file_name})
+    
+    raise ValueError(f"Unknown embedding backend '{backend}', expected one of {', '.join(BACKENDS)}")
+
+def sample_texts(conn, limit=256):
+    """Fetch a sample of comment texts for backend comparisons."""
+    spec = ENTITIES['comment']
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            SELECT {spec.columns}
+            FROM {spec.source} {spec.alias}
+            ORDER BY random()
+            LIMIT %s;
+        """, (limit,))
+        return [spec.compose_text(*row) for row in cursor.fetchall()]
+    
+    finally:
+        cursor.close()
+
+def check_backend_agreement(model, texts, reference=None):
+    """
+    Compare a model's embeddings against the torch backend on sample texts.
+    
+    Returns the minimum and mean cosine similarity between the two backends.
+    """
+    if not texts:
+        logger.warning("No sample texts available for the backend agreement check")
+        return None, None
+    
+    reference = reference or load_model('torch')
+    
+    embeddings = model.encode(texts, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    expected = reference.encode(texts, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    cosines = np.sum(embeddings * expected, axis=1)
+    
+    min_cosine, mean_cosine = float(cosines.min()), float(cosines.mean())
+    logger.info(f"Backend {EMBEDDING_CONFIG['backend']} vs torch on {len(texts)} texts: "
+                f"min cosine {min_cosine:.4f}, mean cosine {mean_cosine:.4f}")
+    if min_cosine < AGREEMENT_THRESHOLD:
+        logger.warning(f"Backend {EMBEDDING_CONFIG['backend']} disagrees with torch "
+                       f"(min cosine {min_cosine:.4f} < {AGREEMENT_THRESHOLD})")
+    
+    return min_cosine, mean_cosine
@@ -0,0 +1,419 @@
+"""
+Benchmark harness for the embedding pipeline.
+
+Seeds synthetic trace data into a local, disposable Postgres database (the one
+configured through DB_* variables), runs each generator in its own process and
+reports per-stage throughput, latency percentiles and peak RSS. Results are
+written as JSON so runs can be compared.
+
+The deterministic fake encoder (--fake-model) measures database and pipeline
+cost on their own; the real model measures end-to-end cost.
+
+--recall measures search instead: recall@k and latency of the configured
+STORAGE_PRECISION against exact full-precision search, for several re-rank
+factors, plus the table and index sizes.
+
+WARNING: --reset drops and recreates the trace and vectors tables.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import random
+import resource
+import subprocess
+import time
+import zlib
+import numpy as np
+import psycopg2
+from config import DB_CONFIG, EMBEDDING_CONFIG, logger
+from create_embeddings import iter_batches
+from db import connect
+from aggregates import ensure_aggregate_tables
+from change_tracking import install_change_tracking
+from entities import ENTITIES
+from indexes import configure_search, create_indexes
+from quantization import ensure_compact_columns, search_query, search_params
+
+WORDS = ('course', 'professor', 'lecture', 'assignment', 'exam', 'helpful', 'clear', 'difficult',
+         'engaging', 'organized', 'feedback', 'project', 'material', 'pace', 'office', 'hours',
+         'recommend', 'learned', 'challenging', 'interesting', 'boring', 'fair', 'grading', 'labs')
+CATEGORIES = ('Positive', 'Negative', 'Neutral', 'Suggestion')
+QUESTIONS = ('What did you like most about this course?', 'What could be improved?',
+             'The instructor was well prepared for class.', 'The course was well organized.',
+             'The instructor provided helpful feedback.', 'Overall rating of the course.')
+
+class FakeModel:
+    """Deterministic stand-in for SentenceTransformer that derives vectors from text hashes."""
+    
+    def __init__(self, dim, latency_ms=0.0):
+        self.dim = dim
+        self.latency = latency_ms / 1000.0
+    
+    def encode(self, texts, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        embeddings = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            embeddings[i] = np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(self.dim)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+class StageTimer:
+    """Collects latencies and item counts of one pipeline stage."""
+    
+    def __init__(self):
+        self.latencies = []
+        self.items = 0
+    
+    def record(self, seconds, items):
+        self.latencies.append(seconds)
+        self.items += items
+    
+    def summary(self):
+        if not self.latencies:
+            return {'calls': 0, 'items': 0}
+        latencies = np.array(self.latencies) * 1000.0
+        total = float(np.sum(latencies)) / 1000.0
+        return {
+            'calls': len(self.latencies),
+            'items': self.items,
+            'total_s': round(total, 4),
+            'items_per_s': round(self.items / total, 1) if total else None,
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        }
+
+def _random_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def _copy_rows(cursor, table, columns, rows, chunk_size=100000):
+    """Bulk-load rows with COPY, buffering at most chunk_size rows at a time."""
+    for chunk in iter_batches(rows, chunk_size):
+        buffer = io.StringIO()
+        for row in chunk:
+            buffer.write('\t'.join(str(value) for value in row) + '\n')
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+def seed(conn, comments, ratings, instructors, courses, seed_value):
+    """Recreate the trace and vectors tables and fill them with synthetic rows."""
+    rng = random.Random(seed_value)
+    dim = EMBEDDING_CONFIG['embedding_dim']
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        cursor.execute("DROP SCHEMA IF EXISTS vectors CASCADE;")
+        cursor.execute("DROP SCHEMA IF EXISTS trace CASCADE;")
+        cursor.execute("CREATE SCHEMA trace;")
+        cursor.execute("CREATE SCHEMA vectors;")
+        cursor.execute("""
+            CREATE TABLE trace.courses (
+                id SERIAL PRIMARY KEY, course_id TEXT, course_name TEXT, subject TEXT,
+                catalog_section TEXT, semester TEXT, year INTEGER, enrollment INTEGER,
+                responses INTEGER, embedding_needed BOOLEAN DEFAULT TRUE
+            );
+            CREATE TABLE trace.instructors (
+                id SERIAL PRIMARY KEY, name TEXT, embedding_needed BOOLEAN DEFAULT TRUE
+            );
+            CREATE TABLE trace.course_instructors (
+                course_id INTEGER REFERENCES trace.courses (id),
+                instructor_id INTEGER REFERENCES trace.instructors (id),
+                PRIMARY KEY (course_id, instructor_id)
+            );
+            CREATE TABLE trace.comments (
+                id SERIAL PRIMARY KEY, course_id INTEGER REFERENCES trace.courses (id),
+                question_text TEXT, comment_text TEXT, category TEXT,
+                embedding_needed BOOLEAN DEFAULT TRUE
+            );
+            CREATE TABLE trace.ratings (
+                id SERIAL PRIMARY KEY, course_id INTEGER REFERENCES trace.courses (id),
+                question_text TEXT, category TEXT, course_mean NUMERIC(3, 2),
+                embedding_needed BOOLEAN DEFAULT TRUE
+            );
+        """)
+        for entity, source in (('comment', 'comments'), ('rating', 'ratings'),
+                               ('instructor', 'instructors'), ('course', 'courses')):
+            cursor.execute(f"""
+                CREATE TABLE vectors.{entity}_embeddings (
+                    id SERIAL PRIMARY KEY,
+                    {entity}_id INTEGER UNIQUE REFERENCES trace.{source} (id),
+                    embedding vector({dim}),
+                    text_hash TEXT,
+                    model_version TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+        
+        _copy_rows(cursor, 'trace.courses',
+                   ('course_id', 'course_name', 'subject', 'catalog_section', 'semester', 'year', 'enrollment', 'responses'),
+                   ((f"CS{1000 + i}", _random_text(rng, 3).title(), 'Computer Science', f"{i % 5:03d}",
+                     rng.choice(('Fall', 'Spring', 'Summer')), rng.randint(2015, 2025),
+                     rng.randint(10, 300), rng.randint(1, 100)) for i in range(courses)))
+        _copy_rows(cursor, 'trace.instructors', ('name',),
+                   ((f"Instructor {i}",) for i in range(instructors)))
+        links = {(rng.randint(1, courses), rng.randint(1, instructors)) for _ in range(courses * 2)}
+        _copy_rows(cursor, 'trace.course_instructors', ('course_id', 'instructor_id'), sorted(links))
+        _copy_rows(cursor, 'trace.comments', ('course_id', 'question_text', 'comment_text', 'category'),
+                   ((rng.randint(1, courses), rng.choice(QUESTIONS), _random_text(rng, rng.randint(5, 120)),
+                     rng.choice(CATEGORIES)) for _ in range(comments)))
+        _copy_rows(cursor, 'trace.ratings', ('course_id', 'question_text', 'category', 'course_mean'),
+                   ((rng.randint(1, courses), rng.choice(QUESTIONS), rng.choice(CATEGORIES),
+                     f"{rng.uniform(1, 5):.2f}") for _ in range(ratings)))
+        
+        cursor.execute("ANALYZE;")
+        conn.commit()
+        
+        # After the bulk load, so seeding does not fire the triggers
+        install_change_tracking(conn)
+        ensure_aggregate_tables(conn)
+        logger.info(f"Seeded {comments} comments, {ratings} ratings, {instructors} instructors, {courses} courses")
+    
+    except Exception:
+        conn.rollback()
+        raise
+    
+    finally:
+        cursor.close()
+
+def _reset_entity(entity):
+    """Clear an entity's embeddings and flag all its rows as pending."""
+    conn = psycopg2.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"TRUNCATE vectors.{entity}_embeddings;")
+        cursor.execute(f"UPDATE trace.{entity}s SET embedding_needed = TRUE;")
+        conn.commit()
+    
+    finally:
+        cursor.close()
+        conn.close()
+
+def _run_generator(entity, fake_model, fake_latency_ms, settings):
+    """Run one generator with timed stages. Executed in a fresh process."""
+    import create_embeddings
+    
+    EMBEDDING_CONFIG.update(settings)
+    
+    if fake_model:
+        model = FakeModel(EMBEDDING_CONFIG['embedding_dim'], fake_latency_ms)
+    else:
+        from backends import load_model
+        model = load_model()
+    
+    stages = {'fetch': StageTimer(), 'encode': StageTimer(), 'write': StageTimer()}
+    
+    original_encode = model.encode
+    def timed_encode(texts, **kwargs):
+        start = time.perf_counter()
+        result = original_encode(texts, **kwargs)
+        stages['encode'].record(time.perf_counter() - start, len(texts))
+        return result
+    model.encode = timed_encode
+    
+    original_write = create_embeddings.write_embeddings
+    def timed_write(conn, results, *args, **kwargs):
+        start = time.perf_counter()
+        count = original_write(conn, results, *args, **kwargs)
+        stages['write'].record(time.perf_counter() - start, count)
+        return count
+    create_embeddings.write_embeddings = timed_write
+    
+    original_stream = create_embeddings.stream_rows
+    def timed_stream(conn, query, id_range=None):
+        # Time spent waiting on the underlying stream, recorded per page
+        rows = original_stream(conn, query, id_range)
+        page_seconds, page_rows = 0.0, 0
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                break
+            page_seconds += time.perf_counter() - start
+            page_rows += 1
+            if page_rows == EMBEDDING_CONFIG['fetch_size']:
+                stages['fetch'].record(page_seconds, page_rows)
+                page_seconds, page_rows = 0.0, 0
+            yield row
+        if page_rows:
+            stages['fetch'].record(page_seconds, page_rows)
+    create_embeddings.stream_rows = timed_stream
+    
+    conn = connect()
+    try:
+        start = time.perf_counter()
+        processed = create_embeddings.generate_embeddings(conn, model, ENTITIES[entity])
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.close()
+    
+    return {
+        'rows': processed,
+        'seconds': round(elapsed, 4),
+        'rows_per_s': round(processed / elapsed, 1) if elapsed else None,
+        'stages': {
+            'fetch': stages['fetch'].summary(),
+            'encode': stages['encode'].summary(),
+            'write': stages['write'].summary(),
+        },
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+def benchmark_recall(conn, entity, k, queries, factors=(1, 2, 4, 8, 16)):
+    """
+    Compare the configured search against exact search on stored embeddings.
+    
+    Query vectors are sampled from the table itself (each query excludes its own
+    row). Returns recall@k and latency percentiles per re-rank factor, and the
+    table and index sizes.
+    """
+    spec = ENTITIES[entity]
+    ensure_compact_columns(conn, [entity])
+    create_indexes(conn, [entity])
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            SELECT {spec.id_column}, embedding::text FROM {spec.vector_table}
+            ORDER BY random() LIMIT %s;
+        """, (queries,))
+        samples = cursor.fetchall()
+        
+        # Ground truth from a sequential scan at full precision
+        cursor.execute("SET enable_indexscan = off;")
+        exact = {}
+        for query_id, embedding in samples:
+            cursor.execute(f"""
+                SELECT {spec.id_column} FROM {spec.vector_table}
+                WHERE {spec.id_column} <> %s
+                ORDER BY embedding <=> %s::vector LIMIT %s;
+            """, (query_id, embedding, k))
+            exact[query_id] = {row[0] for row in cursor.fetchall()}
+        cursor.execute("RESET enable_indexscan;")
+        
+        sql = search_query(spec, exclude_id=True)
+        results = {}
+        for factor in (factors if EMBEDDING_CONFIG['storage']['precision'] != 'fp32' else (1,)):
+            timer = StageTimer()
+            hits = 0
+            configure_search(cursor, search_params(None, k, rerank_factor=factor)['candidates'])
+            for query_id, embedding in samples:
+                start = time.perf_counter()
+                cursor.execute(sql, search_params(embedding, k, query_id, factor))
+                found = {row[0] for row in cursor.fetchall()}
+                timer.record(time.perf_counter() - start, 1)
+                hits += len(found & exact[query_id])
+            summary = timer.summary()
+            results[f"rerank_{factor}"] = {
+                'recall': round(hits / max(1, sum(len(ids) for ids in exact.values())), 4),
+                'p50_ms': summary.get('p50_ms'),
+                'p95_ms': summary.get('p95_ms'),
+            }
+            logger.info(f"{entity} search, re-rank factor {factor}: recall@{k} {results[f'rerank_{factor}']['recall']}, "
+                        f"p50 {summary.get('p50_ms')} ms, p95 {summary.get('p95_ms')} ms")
+        
+        cursor.execute("SELECT pg_table_size(%s::regclass), pg_indexes_size(%s::regclass);",
+                       (spec.vector_table, spec.vector_table))
+        table_bytes, index_bytes = cursor.fetchone()
+        conn.commit()
+        return {
+            'precision': EMBEDDING_CONFIG['storage']['precision'],
+            'index': EMBEDDING_CONFIG['index']['type'],
+            'k': k,
+            'queries': len(samples),
+            'table_mb': round(table_bytes / 2**20, 1),
+            'indexes_mb': round(index_bytes / 2**20, 1),
+            'results': results,
+        }
+    
+    finally:
+        cursor.close()
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return None
+
+def compare(previous, current):
+    """Log the throughput change of each generator between two result files."""
+    for entity, result in current['results'].items():
+        before = previous.get('results', {}).get(entity)
+        if not before or not before.get('rows_per_s') or not result.get('rows_per_s'):
+            continue
+        change = (result['rows_per_s'] - before['rows_per_s']) / before['rows_per_s'] * 100
+        logger.info(f"{entity}: {before['rows_per_s']} -> {result['rows_per_s']} rows/s ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the embedding pipeline against a local Postgres')
+    parser.add_argument('--rows', type=int, default=10000, help='Number of comments and ratings to seed')
+    parser.add_argument('--instructors', type=int, default=None, help='Number of instructors (default: rows / 100)')
+    parser.add_argument('--courses', type=int, default=None, help='Number of courses (default: rows / 20)')
+    parser.add_argument('--reset', action='store_true', help='Drop and reseed the trace and vectors tables')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for synthetic data')
+    parser.add_argument('--fake-model', action='store_true', help='Use the deterministic fake encoder')
+    parser.add_argument('--fake-latency-ms', type=float, default=0.0, help='Simulated latency per fake encode call')
+    parser.add_argument('--entities', default='comment,rating,instructor,course', help='Comma-separated generators to run')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', help='Previous JSON results to compare against')
+    parser.add_argument('--recall', action='store_true', help='Also measure search recall and latency of the configured STORAGE_PRECISION')
+    parser.add_argument('--recall-k', type=int, default=10, help='Number of neighbours for --recall')
+    parser.add_argument('--recall-queries', type=int, default=200, help='Number of sampled queries for --recall')
+    args = parser.parse_args()
+    
+    if args.reset:
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            seed(conn, args.rows, args.rows, args.instructors or max(1, args.rows // 100),
+                 args.courses or max(1, args.rows // 20), args.seed)
+        finally:
+            conn.close()
+    
+    # Measure the pipeline itself, not the cache or index maintenance
+    settings = {'cache_enabled': False}
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    
+    for entity in args.entities.split(','):
+        _reset_entity(entity)
+        with context.Pool(1) as pool:
+            results[entity] = pool.apply(_run_generator, (entity, args.fake_model, args.fake_latency_ms, settings))
+        logger.info(f"{entity}: {results[entity]['rows']} rows in {results[entity]['seconds']}s "
+                    f"({results[entity]['rows_per_s']} rows/s, peak RSS {results[entity]['peak_rss_mb']} MB)")
+    
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': _git_revision(),
+            'rows': args.rows,
+            'model': 'fake' if args.fake_model else EMBEDDING_CONFIG['model_name'],
+            'backend': None if args.fake_model else EMBEDDING_CONFIG['backend'],
+            'batch_size': EMBEDDING_CONFIG['batch_size'],
+            'fetch_size': EMBEDDING_CONFIG['fetch_size'],
+            'write_chunk_size': EMBEDDING_CONFIG['write_chunk_size'],
+        },
+        'results': results,
+    }
+    
+    if args.recall:
+        conn = connect()
+        try:
+            report['recall'] = {entity: benchmark_recall(conn, entity, args.recall_k, args.recall_queries)
+                                for entity in args.entities.split(',')}
+        finally:
+            conn.close()
+    
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote benchmark results to {args.output}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
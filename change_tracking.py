@@ -0,0 +1,201 @@
+"""
+Change detection for the embedding sources.
+
+Rows are flagged with embedding_needed by triggers instead of by whoever
+changes them:
+- an update of any column of a source row flags the row itself;
+- a change to a table an entity's text is joined from (declared as the spec's
+  dependencies) flags the entity rows it affects, e.g. a new course_instructors
+  link flags its instructor and its course, and drops their precomputed
+  aggregates so they are refreshed (see aggregates.py).
+
+Flagging is deliberately coarse. The vectors tables store a hash of the text
+each embedding was computed from, and flagged rows whose composed text still
+has the same hash are cleared without being encoded or rewritten. A partial
+index on each source table keeps the pending set cheap to find.
+
+Every flag is an update, so it changes the row's xmin, even for rows that are
+already pending. Writers only clear rows whose xmin is still the one they read,
+so a row that changes while its old text is being embedded stays flagged.
+"""
+import hashlib
+from config import EMBEDDING_CONFIG, logger
+from entities import ENTITIES
+
+def _function_name(name):
+    return f"{EMBEDDING_CONFIG['schema']['vector']}.{name}"
+
+def _pending_index(spec):
+    return f"{EMBEDDING_CONFIG['schema']['source']}.{spec.source_table}_embedding_pending_idx"
+
+def _add_column(cursor, table, column, definition):
+    """Add a column unless it exists; ALTER TABLE locks the table even when it has nothing to do."""
+    cursor.execute("""
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped;
+    """, (table, column))
+    if not cursor.fetchone():
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+        logger.info(f"Added {column} column to {table}")
+
+def _install_function(cursor, name, body):
+    """Create or replace a trigger function unless it already has this body."""
+    cursor.execute("SELECT prosrc FROM pg_proc WHERE oid = to_regprocedure(%s);", (f"{name}()",))
+    row = cursor.fetchone()
+    if row and row[0] == body:
+        return
+    cursor.execute(f"CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $${body}$$ LANGUAGE plpgsql;")
+
+def _install_trigger(cursor, name, table, definition):
+    """
+    Create or replace a trigger unless it already has this definition.
+    
+    Replacing a trigger locks its table, so the hash of the definition is kept
+    in the trigger's comment and unchanged triggers are left alone.
+    """
+    digest = hashlib.sha256(definition.encode('utf-8')).hexdigest()
+    cursor.execute("""
+        SELECT obj_description(oid, 'pg_trigger') FROM pg_trigger
+        WHERE tgrelid = %s::regclass AND tgname = %s;
+    """, (table, name))
+    row = cursor.fetchone()
+    if row and row[0] == digest:
+        return
+    cursor.execute(f"CREATE OR REPLACE TRIGGER {name} {definition};")
+    cursor.execute(f"COMMENT ON TRIGGER {name} ON {table} IS %s;", (digest,))
+    logger.info(f"Installed trigger {name} on {table}")
+
+def install_change_tracking(conn):
+    """Create the text hash columns, pending indexes and change detection triggers."""
+    cursor = conn.cursor()
+    schema = EMBEDDING_CONFIG['schema']['source']
+    
+    try:
+        _install_function(cursor, _function_name('flag_changed_row'), """
+            BEGIN
+                IF (to_jsonb(NEW) - 'embedding_needed') IS DISTINCT FROM (to_jsonb(OLD) - 'embedding_needed') THEN
+                    NEW.embedding_needed := TRUE;
+                END IF;
+                RETURN NEW;
+            END;
+        """)
+        
+        for spec in ENTITIES.values():
+            # Checked first so busy tables are not locked on every start
+            _add_column(cursor, spec.source, 'embedding_needed', 'BOOLEAN DEFAULT TRUE')
+            _add_column(cursor, spec.vector_table, 'text_hash', 'TEXT')
+            # Model name, revision and dimension each embedding was computed with
+            _add_column(cursor, spec.vector_table, 'model_version', 'TEXT')
+            
+            _install_trigger(cursor, 'flag_changed_row', spec.source, f"""
+                BEFORE UPDATE ON {spec.source}
+                FOR EACH ROW
+                EXECUTE FUNCTION {_function_name('flag_changed_row')}()
+            """)
+            
+            for dependency in spec.dependencies:
+                function = _function_name(f"flag_{spec.name}_on_{dependency.table}_change")
+                ids = dependency.ids.format(source=schema, row='{row}')
+                # Pending rows are updated too, so their writers see a new xmin
+                flag = f"""
+                    UPDATE {spec.source} SET embedding_needed = TRUE
+                    WHERE id IN ({ids});
+                """
+                if spec.aggregate:
+                    flag += f"DELETE FROM {spec.aggregate_table} WHERE {spec.id_column} IN ({ids});"
+                _install_function(cursor, function, f"""
+                    BEGIN
+                        IF TG_OP <> 'INSERT' THEN
+                            {flag.format(row='OLD')}
+                        END IF;
+                        IF TG_OP <> 'DELETE' THEN
+                            {flag.format(row='NEW')}
+                        END IF;
+                        RETURN NULL;
+                    END;
+                """)
+                
+                events = f"UPDATE OF {', '.join(dependency.columns)}" if dependency.columns else "INSERT OR UPDATE OR DELETE"
+                _install_trigger(cursor, f"flag_{spec.name}_embedding", f"{schema}.{dependency.table}", f"""
+                    AFTER {events} ON {schema}.{dependency.table}
+                    FOR EACH ROW
+                    EXECUTE FUNCTION {function}()
+                """)
+        
+        conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error installing embedding change detection: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+    
+    for spec in ENTITIES.values():
+        create_pending_index(conn, spec)
+    logger.info("Installed embedding change detection")
+
+def create_pending_index(conn, spec):
+    """
+    Build the partial index on a source table's pending rows if it is missing.
+    
+    The index is built CONCURRENTLY, outside a transaction, so writes to the
+    source table are not blocked. An invalid index left by an interrupted
+    build is dropped and built again.
+    """
+    index = _pending_index(spec)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (index,))
+        row = cursor.fetchone()
+        conn.commit()
+        if row and row[0]:
+            return
+        
+        conn.autocommit = True
+        if row:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index};")
+        # Matches the candidate queries' predicate so the planner can use it
+        cursor.execute(f"""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.split('.')[-1]}
+            ON {spec.source} (id)
+            WHERE embedding_needed IS NOT FALSE;
+        """)
+        logger.info(f"Created {index}")
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error creating {index}: {e}")
+        raise
+    
+    finally:
+        conn.autocommit = False
+        cursor.close()
+
+def lookup_stored_hashes(conn, spec, ids):
+    """Return an {id: text_hash} dict of the texts the stored embeddings were computed from."""
+    if not ids:
+        return {}
+    
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            SELECT {spec.id_column}, text_hash
+            FROM {spec.vector_table}
+            WHERE {spec.id_column} = ANY(%s) AND text_hash IS NOT NULL;
+        """, (list(ids),))
+        
+        stored = dict(cursor.fetchall())
+        conn.commit()
+        return stored
+    
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Stored text hash lookup failed, treating {spec.name}s as changed: {e}")
+        return {}
+    
+    finally:
+        cursor.close()
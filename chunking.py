@@ -0,0 +1,145 @@
+"""
+Chunked embedding of long texts.
+
+Long comments are split into overlapping token windows. Each window is composed
+into its own embedding text (with the question and category), all windows are
+encoded in the shared batches of the pipeline, and the document vector is the
+mean of its window vectors. Window vectors can also be kept in a side table for
+finer-grained search.
+"""
+import copy
+from collections import Counter, defaultdict
+import numpy as np
+from psycopg2.extras import execute_values
+from config import EMBEDDING_CONFIG, logger
+
+class TextSplitter:
+    """Split texts into overlapping windows of at most chunk_size tokens."""
+    
+    def __init__(self, model, chunk_size=None, overlap=None):
+        self.chunk_size = chunk_size or EMBEDDING_CONFIG['chunking']['chunk_size']
+        self.overlap = EMBEDDING_CONFIG['chunking']['overlap'] if overlap is None else overlap
+        if not 0 <= self.overlap < self.chunk_size:
+            raise ValueError(f"Chunk overlap ({self.overlap}) must be smaller than the chunk size ({self.chunk_size})")
+        
+        # The splitter runs on the reader thread while the encoder tokenizes on
+        # another, and fast tokenizers cannot be shared between threads
+        copy_tokenizer = getattr(model, 'copy_tokenizer', None)
+        if copy_tokenizer is not None:
+            self.tokenizer = copy_tokenizer()
+        else:
+            tokenizer = getattr(model, 'tokenizer', None)
+            self.tokenizer = copy.deepcopy(tokenizer) if tokenizer is not None else None
+    
+    def _windows(self, tokens):
+        stride = self.chunk_size - self.overlap
+        return [tokens[start:start + self.chunk_size] for start in range(0, len(tokens) - self.overlap, stride)]
+    
+    def split(self, text):
+        """Return the windows of a text; short texts are returned unchanged."""
+        if self.tokenizer is None:
+            # Models without a tokenizer (e.g. test doubles) are split on words
+            words = text.split()
+            if len(words) <= self.chunk_size:
+                return [text]
+            return [' '.join(window) for window in self._windows(words)]
+        
+        tokens = self.tokenizer(text, add_special_tokens=False, truncation=False)['input_ids']
+        if len(tokens) <= self.chunk_size:
+            return [text]
+        return [self.tokenizer.decode(window) for window in self._windows(tokens)]
+
+def chunking_enabled(spec):
+    """Whether texts of an entity spec are embedded in chunks."""
+    return EMBEDDING_CONFIG['chunking']['enabled'] and spec.chunk_field is not None
+
+def compose_chunks(spec, splitter, row):
+    """Compose one embedding text per window of the spec's chunked column."""
+    values = list(row[2:])
+    text = values[spec.chunk_field]
+    if text is None:
+        return [spec.compose_text(*values)]
+    
+    texts = []
+    for window in splitter.split(text):
+        values[spec.chunk_field] = window
+        texts.append(spec.compose_text(*values))
+    return texts
+
+def pool_chunks(batch, results):
+    """
+    Mean-pool chunk embeddings into document embeddings.
+    
+    batch holds the ((id, chunk index), text, text_hash) rows that were encoded
+    and results the ((id, chunk index), embedding) pairs. Returns a list of
+    (id, document embedding) pairs and a list of (id, chunk index, embedding)
+    chunks. Documents with a chunk that failed to encode are left out so they
+    stay pending.
+    """
+    expected = Counter(entity_id for (entity_id, _), _, _ in batch)
+    by_id = defaultdict(list)
+    for (entity_id, index), embedding in results:
+        by_id[entity_id].append((index, embedding))
+    
+    documents = []
+    chunks = []
+    for entity_id, parts in by_id.items():
+        if len(parts) != expected[entity_id]:
+            continue
+        documents.append((entity_id, np.mean([embedding for _, embedding in parts], axis=0)))
+        chunks.extend((entity_id, index, embedding) for index, embedding in parts)
+    
+    return documents, chunks
+
+def create_chunk_table(cursor, spec):
+    """Create the chunk side table of an entity spec, referencing its vectors table, if it does not exist."""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {spec.chunk_table} (
+            {spec.id_column} INTEGER NOT NULL REFERENCES {spec.vector_table} ({spec.id_column}) ON DELETE CASCADE,
+            chunk_index INTEGER NOT NULL,
+            embedding vector({EMBEDDING_CONFIG['embedding_dim']}) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ({spec.id_column}, chunk_index)
+        );
+    """)
+
+def ensure_chunk_tables(conn, entities):
+    """Create the chunk side tables of the given entity types if they do not exist."""
+    from entities import ENTITIES
+    
+    cursor = conn.cursor()
+    
+    try:
+        for entity in entities:
+            spec = ENTITIES[entity]
+            if spec.chunk_field is None:
+                continue
+            create_chunk_table(cursor, spec)
+            logger.info(f"Chunk table {spec.chunk_table} is ready")
+        conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error creating chunk tables: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def store_chunks(cursor, spec, ids, chunks):
+    """
+    Replace the stored chunks of the given ids.
+    
+    Runs on the caller's cursor so the chunks commit together with their
+    document embeddings.
+    """
+    cursor.execute(f"DELETE FROM {spec.chunk_table} WHERE {spec.id_column} = ANY(%s);", (ids,))
+    if not chunks:
+        return
+    
+    execute_values(
+        cursor,
+        f"INSERT INTO {spec.chunk_table} ({spec.id_column}, chunk_index, embedding) VALUES %s",
+        chunks,
+        page_size=len(chunks)
+    )
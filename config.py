@@ -28,10 +28,69 @@ DB_CONFIG = {
 # Embedding configuration
 EMBEDDING_CONFIG = {
     'model_name': os.environ.get('EMBEDDING_MODEL', 'all-MiniLM-L6-v2'),
+    'model_path': os.environ.get('MODEL_PATH', ''),  # local model directory, loaded without hub lookups
+    'model_revision': os.environ.get('MODEL_REVISION', ''),  # hub revision when loading by name
+    'warm_up': os.environ.get('MODEL_WARM_UP', 'true').lower() == 'true',
+    'backend': os.environ.get('EMBEDDING_BACKEND', 'torch'),  # torch, onnx or onnx-int8
+    'onnx_quantization': os.environ.get('ONNX_QUANTIZATION', 'avx2'),  # arm64, avx2, avx512 or avx512_vnni
+    'onnx_model_dir': os.environ.get('ONNX_MODEL_DIR', 'onnx-models'),
     'embedding_dim': int(os.environ.get('EMBEDDING_DIM', '384')),  # Dimension for all-MiniLM-L6-v2
     'batch_size': int(os.environ.get('BATCH_SIZE', '32')),
+    'sort_window': int(os.environ.get('SORT_WINDOW', '8')),  # batches pooled for length-sorted encoding
+    'max_seq_length': int(os.environ['MAX_SEQ_LENGTH']) if os.environ.get('MAX_SEQ_LENGTH') else None,  # model default if unset
+    'fetch_size': int(os.environ.get('FETCH_SIZE', '1000')),  # candidate rows fetched per page
+    'write_chunk_size': int(os.environ.get('WRITE_CHUNK_SIZE', '500')),  # rows per bulk write/commit
+    'queue_size': int(os.environ.get('PIPELINE_QUEUE_SIZE', '4')),  # batches buffered between pipeline stages
+    'cache_enabled': os.environ.get('EMBEDDING_CACHE', 'true').lower() == 'true',
+    'metrics_textfile': os.environ.get('METRICS_TEXTFILE', ''),  # Prometheus textfile path, disabled if empty
+    'log_sample_every': int(os.environ.get('LOG_SAMPLE_EVERY', '100')),  # log one in N stored chunks at DEBUG
     'max_retries': int(os.environ.get('MAX_RETRIES', '3')),
     'retry_delay': int(os.environ.get('RETRY_DELAY', '5')),  # seconds
+    'chunking': {
+        'enabled': os.environ.get('CHUNK_LONG_TEXTS', 'false').lower() == 'true',
+        'chunk_size': int(os.environ.get('CHUNK_SIZE', '192')),  # tokens of the chunked column per window
+        'overlap': int(os.environ.get('CHUNK_OVERLAP', '32')),  # tokens shared by consecutive windows
+        'store_chunks': os.environ.get('STORE_CHUNK_EMBEDDINGS', 'false').lower() == 'true',
+    },
+    'daemon': {
+        'channel': os.environ.get('NOTIFY_CHANNEL', 'embedding_needed'),
+        'poll_interval': float(os.environ.get('POLL_INTERVAL', '60')),  # seconds
+        'batch_window': float(os.environ.get('DAEMON_BATCH_WINDOW', '2')),  # seconds
+    },
+    'server': {
+        'host': os.environ.get('SERVER_HOST', '0.0.0.0'),
+        'port': int(os.environ.get('SERVER_PORT', '8080')),
+        'max_batch_size': int(os.environ.get('SERVER_MAX_BATCH_SIZE', '64')),
+        'max_wait_ms': float(os.environ.get('SERVER_MAX_WAIT_MS', '10')),
+        'query_cache_size': int(os.environ.get('QUERY_CACHE_SIZE', '10000')),
+        'max_connections': int(os.environ.get('SERVER_MAX_CONNECTIONS', '10')),
+        'max_k': int(os.environ.get('SERVER_MAX_K', '100')),  # largest k accepted by /search
+    },
+    'index': {
+        'type': os.environ.get('INDEX_TYPE', 'hnsw'),  # hnsw, ivfflat or none
+        'hnsw_m': int(os.environ.get('HNSW_M', '16')),
+        'hnsw_ef_construction': int(os.environ.get('HNSW_EF_CONSTRUCTION', '64')),
+        'hnsw_ef_search': int(os.environ.get('HNSW_EF_SEARCH', '40')),
+        'ivfflat_lists': int(os.environ.get('IVFFLAT_LISTS', '100')),
+        'ivfflat_probes': int(os.environ.get('IVFFLAT_PROBES', '10')),
+        'maintenance_work_mem': os.environ.get('INDEX_MAINTENANCE_WORK_MEM', '1GB'),
+    },
+    'storage': {
+        'precision': os.environ.get('STORAGE_PRECISION', 'fp32'),  # fp32, halfvec or binary
+        'rerank_factor': int(os.environ.get('RERANK_FACTOR', '4')),  # compact candidates per result re-ranked at fp32
+    },
+    'rebuild': {
+        'range_size': int(os.environ.get('REBUILD_RANGE_SIZE', '50000')),  # ids per checkpointed range
+        'lease': float(os.environ.get('REBUILD_LEASE', '600')),  # seconds before a silent worker's range is reclaimed
+    },
+    'shadow': {
+        'rows_per_second': float(os.environ.get('SHADOW_ROWS_PER_SECOND', '0')),  # shadow re-embedding rate, 0 for unlimited
+    },
+    'snapshot': {
+        'dir': os.environ.get('SNAPSHOT_DIR', 'snapshots'),
+        'query_chunk': int(os.environ.get('SNAPSHOT_QUERY_CHUNK', '1024')),  # queries scored together
+        'block_rows': int(os.environ.get('SNAPSHOT_BLOCK_ROWS', '65536')),  # snapshot rows scored per matrix multiply
+    },
     'schema': {
         'vector': os.environ.get('VECTOR_SCHEMA', 'vectors'),
         'source': os.environ.get('SOURCE_SCHEMA', 'trace'),
@@ -41,5 +100,14 @@ EMBEDDING_CONFIG = {
         'rating': os.environ.get('RATING_EMBEDDING_TABLE', 'rating_embeddings'),
         'instructor': os.environ.get('INSTRUCTOR_EMBEDDING_TABLE', 'instructor_embeddings'),
         'course': os.environ.get('COURSE_EMBEDDING_TABLE', 'course_embeddings'),
+        'instructor_aggregate': os.environ.get('INSTRUCTOR_AGGREGATE_TABLE', 'instructor_aggregates'),
+        'course_aggregate': os.environ.get('COURSE_AGGREGATE_TABLE', 'course_aggregates'),
+        'comment_chunk': os.environ.get('COMMENT_CHUNK_TABLE', 'comment_chunk_embeddings'),
+        'comment_neighbors': os.environ.get('COMMENT_NEIGHBORS_TABLE', 'comment_neighbors'),
+        'rating_neighbors': os.environ.get('RATING_NEIGHBORS_TABLE', 'rating_neighbors'),
+        'instructor_neighbors': os.environ.get('INSTRUCTOR_NEIGHBORS_TABLE', 'instructor_neighbors'),
+        'course_neighbors': os.environ.get('COURSE_NEIGHBORS_TABLE', 'course_neighbors'),
+        'rebuild_checkpoint': os.environ.get('REBUILD_CHECKPOINT_TABLE', 'rebuild_checkpoints'),
+        'cache': os.environ.get('EMBEDDING_CACHE_TABLE', 'embedding_cache'),
     }
 }
\ No newline at end of file
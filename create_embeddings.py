@@ -1,491 +1,536 @@
-import psycopg2
-from sentence_transformers import SentenceTransformer
+import queue
+import threading
 import time
-from config import DB_CONFIG, EMBEDDING_CONFIG, logger
+from config import EMBEDDING_CONFIG, logger
+from db import get_connection, release_connection, copy_embeddings
+from metrics import METRICS
+from entities import ENTITIES
+from embedding_cache import text_hash, lookup_cached_embeddings, store_cached_embeddings
+from aggregates import refresh_aggregates
+from backends import model_version
+from change_tracking import lookup_stored_hashes
+from chunking import TextSplitter, chunking_enabled, compose_chunks, pool_chunks, store_chunks
+from search import Query, search
 
-def generate_comment_embeddings(conn, model):
-    """Generate embeddings for comments that need them."""
-    cursor = conn.cursor()
+# Marks the end of a pipeline queue
+_END_OF_STREAM = object()
+
+def iter_batches(rows, batch_size):
+    """Group an iterable of rows into lists of at most batch_size rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def encode_texts(model, texts):
+    """Encode a list of texts with a single model call, returning a NumPy array."""
+    return model.encode(
+        texts,
+        batch_size=EMBEDDING_CONFIG['batch_size'],
+        convert_to_numpy=True,
+        show_progress_bar=False
+    )
+
+def encode_with_retry(model, text, entity, entity_id):
+    """Encode a single text, retrying on failure."""
+    retry_count = 0
+    while retry_count < EMBEDDING_CONFIG['max_retries']:
+        try:
+            return encode_texts(model, [text])[0]
+        except Exception as e:
+            retry_count += 1
+            METRICS.inc('retries', entity)
+            logger.warning(f"Retry {retry_count}/{EMBEDDING_CONFIG['max_retries']} for {entity} ID {entity_id}: {e}")
+            if retry_count >= EMBEDDING_CONFIG['max_retries']:
+                raise
+            time.sleep(EMBEDDING_CONFIG['retry_delay'])
+
+def encode_batch(model, batch, entity):
+    """
+    Encode a batch of (id, text) pairs with one model call.
     
-    try:
-        # Get comments that need embeddings
-        cursor.execute("""
-            SELECT id, question_text, comment_text, category
-            FROM trace.comments
-            WHERE embedding_needed IS NULL OR embedding_needed = TRUE;
-        """)
-        
-        comments = cursor.fetchall()
-        logger.info(f"Found {len(comments)} comments to process")
-        processed_count = 0
-        
-        for comment_id, question_text, comment_text, category in comments:
-            try:
-                # Generate text for embedding
-                text = f"Question: {question_text}. Comment: {comment_text}. Category: {category}"
-                
-                # Generate embedding with retry logic
-                retry_count = 0
-                while retry_count < EMBEDDING_CONFIG['max_retries']:
-                    try:
-                        embedding = model.encode(text).tolist()
-                        break
-                    except Exception as e:
-                        retry_count += 1
-                        logger.warning(f"Retry {retry_count}/{EMBEDDING_CONFIG['max_retries']} for comment ID {comment_id}: {e}")
-                        if retry_count >= EMBEDDING_CONFIG['max_retries']:
-                            raise
-                        time.sleep(EMBEDDING_CONFIG['retry_delay'])
-                
-                # Store embedding in vectors schema
-                cursor.execute("""
-                    INSERT INTO vectors.comment_embeddings (comment_id, embedding)
-                    VALUES (%s, %s)
-                    ON CONFLICT (comment_id) DO UPDATE
-                    SET embedding = EXCLUDED.embedding, 
-                        created_at = CURRENT_TIMESTAMP;
-                """, (comment_id, embedding))
-                
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE trace.comments
-                    SET embedding_needed = FALSE
-                    WHERE id = %s;
-                """, (comment_id,))
-                
-                processed_count += 1
-                logger.info(f"Processed comment ID: {comment_id}")
-                
-                # Commit after each successful embedding to prevent losing progress
-                conn.commit()
-                
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Error processing comment ID {comment_id}: {e}")
-                # Continue with next comment instead of failing the entire batch
-        
-        return processed_count
+    Rows are only retried one at a time if the whole batch fails. Returns a list
+    of (id, embedding) pairs for the rows that were encoded successfully.
+    """
+    ids = [entity_id for entity_id, _ in batch]
+    texts = [text for _, text in batch]
     
+    try:
+        return list(zip(ids, encode_texts(model, texts)))
     except Exception as e:
-        conn.rollback()
-        logger.error(f"Error in comment embedding generation: {e}")
-        return 0
+        logger.warning(f"Batch encoding of {len(batch)} {entity}s failed, retrying row by row: {e}")
     
-    finally:
-        cursor.close()
+    results = []
+    for entity_id, text in batch:
+        try:
+            results.append((entity_id, encode_with_retry(model, text, entity, entity_id)))
+        except Exception as e:
+            METRICS.inc('errors', entity)
+            logger.error(f"Error processing {entity} ID {entity_id}: {e}")
+            # Continue with the rest of the batch
+    return results
 
-def generate_rating_embeddings(conn, model):
-    """Generate embeddings for ratings that need them."""
+def token_lengths(model, texts):
+    """Tokenized length of each text, including special tokens."""
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        # Models without a tokenizer (e.g. test doubles) are bucketed by word count
+        return [len(text.split()) for text in texts]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=True, truncation=False)['input_ids']]
+
+def encode_sorted(model, batch, entity, stats):
+    """
+    Encode (id, text) pairs in sub-batches of similar tokenized length.
+    
+    Texts are sorted by token count and split into batch_size sub-batches, so
+    each sub-batch only pads to a length close to its own texts instead of the
+    longest text of the window. Texts longer than the model's max_seq_length are
+    truncated by the model; they are counted in stats['truncated']. Returns
+    (id, embedding) pairs in the original order.
+    """
+    lengths = token_lengths(model, [text for _, text in batch])
+    
+    max_seq_length = getattr(model, 'max_seq_length', None)
+    if max_seq_length:
+        truncated = sum(1 for length in lengths if length > max_seq_length)
+        stats['truncated'] += truncated
+        METRICS.inc('truncated', entity, truncated)
+    
+    order = sorted(range(len(batch)), key=lengths.__getitem__)
+    encoded = {}
+    for start in range(0, len(order), EMBEDDING_CONFIG['batch_size']):
+        sub_batch = [batch[i] for i in order[start:start + EMBEDDING_CONFIG['batch_size']]]
+        METRICS.observe_batch(entity, len(sub_batch))
+        encoded.update(encode_batch(model, sub_batch, entity))
+    
+    # Restore the original order
+    return [(entity_id, encoded[entity_id]) for entity_id, _ in batch if entity_id in encoded]
+
+def encode_with_cache(model, batch, cached, entity, stats):
+    """
+    Encode a batch of (id, text, text_hash) rows, skipping the model for cached texts.
+    
+    cached maps text hashes to embeddings already known for the current model.
+    Texts that repeat within the batch are encoded once. Returns the (id, embedding)
+    pairs for the batch and the newly computed (text_hash, embedding) cache entries.
+    """
+    to_encode = {}
+    for entity_id, text, h in batch:
+        if h in cached:
+            stats['hits'] += 1
+        elif h in to_encode:
+            stats['duplicates'] += 1
+        else:
+            to_encode[h] = (entity_id, text)
+            stats['misses'] += 1
+    
+    encoded_by_id = dict(encode_sorted(model, list(to_encode.values()), entity, stats)) if to_encode else {}
+    
+    encoded = {}
+    for h, (entity_id, _) in to_encode.items():
+        if entity_id in encoded_by_id:
+            encoded[h] = encoded_by_id[entity_id]
+    
+    results = []
+    for entity_id, _, h in batch:
+        embedding = cached.get(h)
+        if embedding is None:
+            embedding = encoded.get(h)
+        if embedding is not None:
+            results.append((entity_id, embedding))
+    
+    return results, list(encoded.items())
+
+def write_embeddings(conn, results, spec, cache_entries=None, chunks=None, hashes=None, unchanged=None,
+                     checkpoint=None, failed=None, versions=None):
+    """Bulk-write a chunk of (id, embedding) pairs for an entity spec, with its flags and side tables, and commit it."""
     cursor = conn.cursor()
+    staging_table = f"{EMBEDDING_CONFIG['tables'][spec.name]}_staging"
+    id_column = spec.id_column
+    ids = [entity_id for entity_id, _ in results]
+    hashes = hashes or {}
+    entity = spec.name
+    write_start = time.perf_counter()
     
     try:
-        # Get ratings that need embeddings
-        cursor.execute("""
-            SELECT id, question_text, category, course_mean
-            FROM trace.ratings
-            WHERE embedding_needed IS NULL OR embedding_needed = TRUE;
-        """)
+        if results:
+            # Session-local staging table in the column layout copy_embeddings writes
+            cursor.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {staging_table} (
+                    {id_column} BIGINT,
+                    embedding vector,
+                    text_hash TEXT
+                ) ON COMMIT DELETE ROWS;
+            """)
+            
+            copy_embeddings(cursor, staging_table, id_column,
+                            ((entity_id, embedding, hashes.get(entity_id)) for entity_id, embedding in results))
+            
+            # Merge the staged chunk into the vectors schema
+            cursor.execute(f"""
+                INSERT INTO {spec.vector_table} ({id_column}, embedding, text_hash, model_version)
+                SELECT {id_column}, embedding, text_hash, %s FROM {staging_table}
+                ON CONFLICT ({id_column}) DO UPDATE
+                SET embedding = EXCLUDED.embedding, 
+                    text_hash = EXCLUDED.text_hash,
+                    model_version = EXCLUDED.model_version,
+                    created_at = CURRENT_TIMESTAMP;
+            """, (model_version(),))
         
-        ratings = cursor.fetchall()
-        logger.info(f"Found {len(ratings)} ratings to process")
-        processed_count = 0
+        # Mark the whole chunk, including unchanged rows, as processed; rows
+        # already clear (e.g. during a rebuild) are not rewritten, and rows
+        # changed since they were read keep their flag. Shadow tables leave
+        # the flags to the live writers.
+        if not spec.shadow:
+            processed = ids + list(unchanged or [])
+            versions = versions or {}
+            cursor.execute(f"""
+                UPDATE {spec.source} s
+                SET embedding_needed = FALSE
+                FROM unnest(%s::bigint[], %s::text[]) AS seen(id, version)
+                WHERE s.id = seen.id AND s.xmin::text = seen.version AND s.embedding_needed IS NOT FALSE;
+            """, (processed, [versions.get(entity_id) for entity_id in processed]))
         
-        for rating_id, question_text, category, course_mean in ratings:
-            try:
-                # Generate text for embedding - include score for better semantic understanding
-                text = f"Question: {question_text}. Category: {category}. Score: {course_mean}/5.0"
-                
-                # Generate embedding with retry logic
-                retry_count = 0
-                while retry_count < EMBEDDING_CONFIG['max_retries']:
-                    try:
-                        embedding = model.encode(text).tolist()
-                        break
-                    except Exception as e:
-                        retry_count += 1
-                        logger.warning(f"Retry {retry_count}/{EMBEDDING_CONFIG['max_retries']} for rating ID {rating_id}: {e}")
-                        if retry_count >= EMBEDDING_CONFIG['max_retries']:
-                            raise
-                        time.sleep(EMBEDDING_CONFIG['retry_delay'])
-                
-                # Store embedding in vectors schema
-                cursor.execute("""
-                    INSERT INTO vectors.rating_embeddings (rating_id, embedding)
-                    VALUES (%s, %s)
-                    ON CONFLICT (rating_id) DO UPDATE
-                    SET embedding = EXCLUDED.embedding, 
-                        created_at = CURRENT_TIMESTAMP;
-                """, (rating_id, embedding))
-                
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE trace.ratings
-                    SET embedding_needed = FALSE
-                    WHERE id = %s;
-                """, (rating_id,))
-                
-                processed_count += 1
-                logger.info(f"Processed rating ID: {rating_id}")
-                
-                # Commit after each successful embedding to prevent losing progress
-                conn.commit()
-                
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Error processing rating ID {rating_id}: {e}")
-                # Continue with next rating instead of failing the entire batch
+        if cache_entries:
+            store_cached_embeddings(cursor, cache_entries)
+        if chunks is not None and ids:
+            store_chunks(cursor, spec, ids, chunks)
+        if checkpoint is not None:
+            if failed and not spec.shadow:
+                cursor.execute(f"UPDATE {spec.source} SET embedding_needed = TRUE WHERE id = ANY(%s);", (failed,))
+            checkpoint(cursor)
+        METRICS.add_time(entity, 'write', time.perf_counter() - write_start)
         
-        return processed_count
-    
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error in rating embedding generation: {e}")
-        return 0
+        # Commit per chunk so progress is kept if a later chunk fails
+        with METRICS.timer(entity, 'commit'):
+            conn.commit()
+        return len(ids)
     
     finally:
         cursor.close()
 
-def generate_instructor_embeddings(conn, model):
-    """Generate embeddings for instructors."""
-    cursor = conn.cursor()
+def embed_rows(conn, model, spec, rows, reencode=False, checkpoint=None):
+    """Encode candidate rows of an entity spec through a read, encode and write pipeline; returns the number stored."""
+    batch_queue = queue.Queue(maxsize=EMBEDDING_CONFIG['queue_size'])
+    write_queue = queue.Queue(maxsize=EMBEDDING_CONFIG['queue_size'])
+    stop = threading.Event()
+    counts = {'candidates': 0, 'processed': 0, 'unchanged': 0, 'chunks': 0, 'aborted': False}
+    cache_stats = {'hits': 0, 'misses': 0, 'duplicates': 0, 'truncated': 0}
+    use_cache = EMBEDDING_CONFIG['cache_enabled']
+    entity = spec.name
+    compose_text = spec.compose_text
+    chunked = chunking_enabled(spec)
+    keep_chunks = chunked and EMBEDDING_CONFIG['chunking']['store_chunks']
+    # Built with the first rows to encode: it copies the tokenizer, which
+    # would load a lazy model even when nothing changed
+    splitter = None
+    start = time.perf_counter()
     
-    try:
-        # Get all instructors with their courses
-        cursor.execute("""
-            SELECT i.id, i.name, 
-                   string_agg(DISTINCT c.course_id || ': ' || c.course_name || ' (' || c.semester || ' ' || c.year || ')', ' | ') as courses
-            FROM trace.instructors i
-            LEFT JOIN trace.course_instructors ci ON i.id = ci.instructor_id
-            LEFT JOIN trace.courses c ON ci.course_id = c.id
-            WHERE i.embedding_needed IS NULL OR i.embedding_needed = TRUE
-            GROUP BY i.id, i.name;
-        """)
+    def read_stage():
+        nonlocal splitter
+        try:
+            # Pool several batches so the encoder can sort them by length
+            batches = iter_batches(rows, EMBEDDING_CONFIG['batch_size'] * EMBEDDING_CONFIG['sort_window'])
+            while not stop.is_set():
+                with METRICS.timer(entity, 'fetch'):
+                    rows_batch = next(batches, None)
+                if rows_batch is None:
+                    break
+                counts['candidates'] += len(rows_batch)
+                METRICS.inc('rows_fetched', entity, len(rows_batch))
+                
+                with METRICS.timer(entity, 'compose'):
+                    documents = []
+                    for row in rows_batch:
+                        text = compose_text(*row[2:])
+                        documents.append((row, text, text_hash(text)))
+                
+                # Rows flagged without a change to their text are not encoded again
+                stored = {}
+                if not reencode:
+                    with METRICS.timer(entity, 'cache_lookup'):
+                        stored = lookup_stored_hashes(conn, spec, [row[0] for row, _, _ in documents])
+                unchanged = [row[0] for row, _, h in documents if stored.get(row[0]) == h]
+                hashes = {row[0]: h for row, _, h in documents if stored.get(row[0]) != h}
+                
+                with METRICS.timer(entity, 'compose'):
+                    batch = []
+                    for row, text, h in documents:
+                        if row[0] not in hashes:
+                            continue
+                        if chunked:
+                            if splitter is None:
+                                splitter = TextSplitter(model)
+                            for index, chunk_text in enumerate(compose_chunks(spec, splitter, row)):
+                                batch.append(((row[0], index), chunk_text, text_hash(chunk_text)))
+                        else:
+                            batch.append((row[0], text, h))
+                
+                cached = {}
+                if use_cache and batch:
+                    with METRICS.timer(entity, 'cache_lookup'):
+                        cached = lookup_cached_embeddings(conn, {h for _, _, h in batch})
+                versions = {row[0]: row[1] for row in rows_batch}
+                batch_queue.put((batch, cached, hashes, unchanged, versions, rows_batch[-1][0]))
+        except Exception as e:
+            METRICS.inc('errors', entity)
+            logger.error(f"Error reading {entity}s to process: {e}")
+            if checkpoint is not None:
+                # The rows after the last one read must not be checkpointed as done
+                counts['aborted'] = True
+        finally:
+            batch_queue.put(_END_OF_STREAM)
+    
+    def new_buffer():
+        return {'results': [], 'cache_entries': [], 'chunks': [], 'hashes': {}, 'unchanged': [], 'failed': [],
+                'versions': {}, 'last_id': None}
+    
+    def flush(write_conn, pending):
+        ids = [entity_id for entity_id, _ in pending['results']] + pending['unchanged'] + pending['failed']
+        progress = None
+        if checkpoint is not None:
+            progress = lambda cursor: checkpoint(cursor, pending['last_id'])
+        try:
+            count = write_embeddings(write_conn, pending['results'], spec,
+                                     pending['cache_entries'] if use_cache else None,
+                                     pending['chunks'] if keep_chunks else None,
+                                     pending['hashes'], pending['unchanged'], progress, pending['failed'],
+                                     pending['versions'])
+            METRICS.inc('rows_written', entity, count)
+            METRICS.inc('rows_unchanged', entity, len(pending['unchanged']))
+            counts['unchanged'] += len(pending['unchanged'])
+            counts['chunks'] += 1
+            # Sampled progress log; the run summary carries the totals
+            if counts['chunks'] % EMBEDDING_CONFIG['log_sample_every'] == 1:
+                logger.debug(f"Stored {count} {entity} embeddings, {len(pending['unchanged'])} unchanged "
+                             f"(IDs {ids[0]}..{ids[-1]})")
+            return count
+        except Exception as e:
+            write_conn.rollback()
+            METRICS.inc('errors', entity)
+            logger.error(f"Error storing chunk of {len(ids)} {entity} embeddings "
+                         f"(IDs {ids[0]}..{ids[-1]}): {e}")
+            if checkpoint is not None:
+                # Later chunks must not move the checkpoint past this one
+                raise
+            # Rows stay flagged as needing embeddings and are picked up on the next run
+            return 0
+    
+    def write_stage():
+        write_conn = None
+        pending = new_buffer()
+        ended = False
         
-        instructors = cursor.fetchall()
-        logger.info(f"Found {len(instructors)} instructors to process")
-        processed_count = 0
+        try:
+            write_conn = get_connection()
+            
+            while True:
+                item = write_queue.get()
+                if item is _END_OF_STREAM:
+                    ended = True
+                    break
+                
+                results, cache_entries, chunks, hashes, unchanged, failed, versions, last_id = item
+                pending['last_id'] = last_id
+                pending['versions'].update(versions)
+                pending['failed'].extend(failed)
+                pending['results'].extend(results)
+                pending['cache_entries'].extend(cache_entries)
+                pending['chunks'].extend(chunks)
+                pending['hashes'].update(hashes)
+                pending['unchanged'].extend(unchanged)
+                if len(pending['results']) + len(pending['unchanged']) >= EMBEDDING_CONFIG['write_chunk_size']:
+                    counts['processed'] += flush(write_conn, pending)
+                    pending = new_buffer()
+            
+            if pending['results'] or pending['unchanged'] or pending['failed']:
+                counts['processed'] += flush(write_conn, pending)
         
-        for instructor_id, name, courses in instructors:
-            try:
-                # Generate text for embedding
-                text = f"Instructor: {name}. Teaches courses: {courses or 'None'}"
-                
-                # Generate embedding with retry logic
-                retry_count = 0
-                while retry_count < EMBEDDING_CONFIG['max_retries']:
-                    try:
-                        embedding = model.encode(text).tolist()
-                        break
-                    except Exception as e:
-                        retry_count += 1
-                        logger.warning(f"Retry {retry_count}/{EMBEDDING_CONFIG['max_retries']} for instructor ID {instructor_id}: {e}")
-                        if retry_count >= EMBEDDING_CONFIG['max_retries']:
-                            raise
-                        time.sleep(EMBEDDING_CONFIG['retry_delay'])
-                
-                # Store embedding in vectors schema
-                cursor.execute("""
-                    INSERT INTO vectors.instructor_embeddings (instructor_id, embedding)
-                    VALUES (%s, %s)
-                    ON CONFLICT (instructor_id) DO UPDATE
-                    SET embedding = EXCLUDED.embedding, 
-                        created_at = CURRENT_TIMESTAMP;
-                """, (instructor_id, embedding))
-                
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE trace.instructors
-                    SET embedding_needed = FALSE
-                    WHERE id = %s;
-                """, (instructor_id,))
-                
-                processed_count += 1
-                logger.info(f"Processed instructor ID: {instructor_id}")
-                
-                # Commit after each successful embedding to prevent losing progress
-                conn.commit()
-                
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Error processing instructor ID {instructor_id}: {e}")
-                # Continue with next instructor
+        except Exception as e:
+            METRICS.inc('errors', entity)
+            logger.error(f"Error in {entity} embedding writer: {e}")
+            if checkpoint is not None:
+                counts['aborted'] = True
+            stop.set()
+            # Keep draining so the encoder is never blocked on a dead writer
+            while not ended and write_queue.get() is not _END_OF_STREAM:
+                pass
         
-        return processed_count
+        finally:
+            if write_conn is not None:
+                release_connection(write_conn)
     
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error in instructor embedding generation: {e}")
-        return 0
+    reader = threading.Thread(target=read_stage, name=f"{entity}-reader", daemon=True)
+    writer = threading.Thread(target=write_stage, name=f"{entity}-writer", daemon=True)
+    reader.start()
+    writer.start()
+    
+    try:
+        while not stop.is_set():
+            item = batch_queue.get()
+            if item is _END_OF_STREAM:
+                break
+            batch, cached, hashes, unchanged, versions, last_id = item
+            with METRICS.timer(entity, 'encode'):
+                results, cache_entries = encode_with_cache(model, batch, cached, entity, cache_stats)
+                chunks = []
+                if chunked:
+                    results, chunks = pool_chunks(batch, results)
+            METRICS.inc('rows_encoded', entity, len(results))
+            encoded_ids = {entity_id for entity_id, _ in results}
+            failed = [entity_id for entity_id in hashes if entity_id not in encoded_ids]
+            write_queue.put((results, cache_entries, chunks, hashes, unchanged, failed, versions, last_id))
     
     finally:
-        cursor.close()
+        write_queue.put(_END_OF_STREAM)
+        writer.join()
+        
+        # Unblock the reader if encoding stopped early
+        stop.set()
+        while reader.is_alive():
+            try:
+                batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+    
+    if counts['aborted']:
+        raise RuntimeError(f"Stopped {entity} embedding after an error; "
+                           f"{counts['processed']} embeddings were stored before it")
+    
+    METRICS.add_time(entity, 'total', time.perf_counter() - start)
+    METRICS.inc('cache_hits', entity, cache_stats['hits'])
+    METRICS.inc('cache_misses', entity, cache_stats['misses'])
+    logger.info(f"Found {counts['candidates']} {entity}s to process, stored {counts['processed']}, "
+                f"{counts['unchanged']} unchanged")
+    logger.info(f"Embedding cache for {entity}s: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                f"{cache_stats['duplicates']} duplicates encoded once")
+    if cache_stats['truncated']:
+        logger.info(f"{cache_stats['truncated']} {entity} texts exceeded the model's max_seq_length "
+                    f"and were truncated")
+    return counts['processed']
 
-def generate_course_embeddings(conn, model):
-    """Generate embeddings for courses."""
+def stream_rows(conn, query, id_range=None):
+    """
+    Stream candidate rows page by page using keyset pagination on id.
+    
+    The query must filter on %(last_id)s and %(max_id)s, order by id and limit to
+    %(fetch_size)s rows. Only one page is held in memory at a time, and each page
+    is yielded as soon as it is fetched. id_range is an optional
+    (exclusive lower bound, inclusive upper bound) pair; None means unbounded.
+    """
     cursor = conn.cursor()
+    last_id, max_id = id_range or (None, None)
     
     try:
-        # Get all courses with their instructors
-        cursor.execute("""
-            SELECT c.id, c.course_id, c.course_name, c.subject, c.catalog_section, 
-                   c.semester, c.year, c.enrollment, c.responses,
-                   string_agg(DISTINCT i.name, ', ') as instructors
-            FROM trace.courses c
-            LEFT JOIN trace.course_instructors ci ON c.id = ci.course_id
-            LEFT JOIN trace.instructors i ON ci.instructor_id = i.id
-            WHERE c.embedding_needed IS NULL OR c.embedding_needed = TRUE
-            GROUP BY c.id, c.course_id, c.course_name, c.subject, c.catalog_section, c.semester, c.year, c.enrollment, c.responses;
-        """)
-        
-        courses = cursor.fetchall()
-        logger.info(f"Found {len(courses)} courses to process")
-        processed_count = 0
-        
-        for course_id, course_code, course_name, subject, catalog_section, semester, year, enrollment, responses, instructors in courses:
-            try:
-                # Generate text for embedding
-                text = (f"Course code: {course_code} Course name: {course_name}. "
-                       f"Subject: {subject}. Section: {catalog_section}. "
-                       f"Term: {semester} {year}. "
-                       f"Enrollment: {enrollment} students, {responses} responses. "
-                       f"Instructors: {instructors or 'None'}")                
-                # Generate embedding with retry logic
-                retry_count = 0
-                while retry_count < EMBEDDING_CONFIG['max_retries']:
-                    try:
-                        embedding = model.encode(text).tolist()
-                        break
-                    except Exception as e:
-                        retry_count += 1
-                        logger.warning(f"Retry {retry_count}/{EMBEDDING_CONFIG['max_retries']} for course ID {course_id}: {e}")
-                        if retry_count >= EMBEDDING_CONFIG['max_retries']:
-                            raise
-                        time.sleep(EMBEDDING_CONFIG['retry_delay'])
-                
-                # Store embedding in vectors schema
-                cursor.execute("""
-                    INSERT INTO vectors.course_embeddings (course_id, embedding)
-                    VALUES (%s, %s)
-                    ON CONFLICT (course_id) DO UPDATE
-                    SET embedding = EXCLUDED.embedding, 
-                        created_at = CURRENT_TIMESTAMP;
-                """, (course_id, embedding))
-                
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE trace.courses
-                    SET embedding_needed = FALSE
-                    WHERE id = %s;
-                """, (course_id,))
-                
-                processed_count += 1
-                logger.info(f"Processed course ID: {course_id}")
-                
-                # Commit after each successful embedding to prevent losing progress
-                conn.commit()
-                
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Error processing course ID {course_id}: {e}")
-                # Continue with next course
+        while True:
+            cursor.execute(query, {
+                'last_id': last_id,
+                'max_id': max_id,
+                'fetch_size': EMBEDDING_CONFIG['fetch_size']
+            })
+            page = cursor.fetchall()
+            # End the read transaction so no snapshot is held open between pages
+            conn.commit()
+            if not page:
+                return
+            
+            for row in page:
+                yield row
+            
+            last_id = page[-1][0]
+            if len(page) < EMBEDDING_CONFIG['fetch_size']:
+                return
+    
+    finally:
+        cursor.close()
+
+def generate_embeddings(conn, model, spec, id_range=None):
+    """Generate embeddings for the rows of an entity spec that need them."""
+    try:
+        # Recompute the aggregates invalidated since the last run
+        refresh_aggregates(conn, spec, id_range)
         
-        return processed_count
+        # Stream rows that need embeddings
+        rows = stream_rows(conn, spec.candidate_query(), id_range)
+        return embed_rows(conn, model, spec, rows)
     
     except Exception as e:
         conn.rollback()
-        logger.error(f"Error in course embedding generation: {e}")
+        logger.error(f"Error in {spec.name} embedding generation: {e}")
         return 0
-    
-    finally:
-        cursor.close()
+
+def generate_comment_embeddings(conn, model, id_range=None):
+    """Generate embeddings for comments that need them."""
+    return generate_embeddings(conn, model, ENTITIES['comment'], id_range)
+
+def generate_rating_embeddings(conn, model, id_range=None):
+    """Generate embeddings for ratings that need them."""
+    return generate_embeddings(conn, model, ENTITIES['rating'], id_range)
+
+def generate_instructor_embeddings(conn, model, id_range=None):
+    """Generate embeddings for instructors."""
+    return generate_embeddings(conn, model, ENTITIES['instructor'], id_range)
+
+def generate_course_embeddings(conn, model, id_range=None):
+    """Generate embeddings for courses."""
+    return generate_embeddings(conn, model, ENTITIES['course'], id_range)
 
 def test_similarity_search(conn, model=None):
     """Test similarity search using pgvector."""
     cursor = conn.cursor()
+    queries = []
     
     try:
-        # Check for different types of embeddings
-        tables = ['comment_embeddings', 'rating_embeddings', 'instructor_embeddings', 'course_embeddings']
-        
-        for table in tables:
+        for spec in ENTITIES.values():
             try:
-                cursor.execute(f"SELECT COUNT(*) FROM vectors.{table};")
+                cursor.execute(f"SELECT COUNT(*) FROM {spec.vector_table};")
                 count = cursor.fetchone()[0]
-                logger.info(f"Number of {table}: {count}")
+                logger.info(f"Number of {EMBEDDING_CONFIG['tables'][spec.name]}: {count}")
             except Exception as e:
-                logger.warning(f"Could not count {table}: {e}")
-        
-        # Test comment embeddings search if available
-        try:
-            cursor.execute("SELECT COUNT(*) FROM vectors.comment_embeddings;")
-            if cursor.fetchone()[0] > 0:
-                # Get a random comment embedding for testing
-                cursor.execute("""
-                    SELECT ce.comment_id, c.question_text, c.comment_text, c.category, ce.embedding
-                    FROM vectors.comment_embeddings ce
-                    JOIN trace.comments c ON ce.comment_id = c.id
-                    LIMIT 1;
-                """)
-                
-                result = cursor.fetchone()
-                if result:
-                    comment_id, question, comment, category, embedding = result
-                    logger.info(f"Testing comment similarity search with comment ID: {comment_id}")
-                    logger.info(f"Query text: {comment[:50]}...")
-                    
-                    # Find similar comments using vector similarity
-                    cursor.execute("""
-                        SELECT 
-                            c.id,
-                            c.question_text,
-                            c.comment_text,
-                            c.category,
-                            1 - (ce.embedding <=> %s::vector) AS similarity
-                        FROM 
-                            vectors.comment_embeddings ce
-                        JOIN 
-                            trace.comments c ON ce.comment_id = c.id
-                        WHERE 
-                            ce.comment_id != %s
-                        ORDER BY 
-                            ce.embedding <=> %s::vector
-                        LIMIT 3;
-                    """, (embedding, comment_id, embedding))
-                    
-                    similar_comments = cursor.fetchall()
-                    
-                    logger.info(f"Found {len(similar_comments)} similar comments:")
-                    for similar_id, similar_question, similar_comment, similar_category, similarity in similar_comments:
-                        logger.info("-" * 50)
-                        logger.info(f"Comment ID: {similar_id}")
-                        logger.info(f"Similarity: {similarity:.4f}")
-                        logger.info(f"Category: {similar_category}")
-                        logger.info(f"Question: {similar_question}")
-                        logger.info(f"Comment: {similar_comment[:100]}...")
-        except Exception as e:
-            logger.warning(f"Could not test comment similarity search: {e}")
-            conn.rollback()  # Reset transaction state
-        
-        # Test instructor search if model is provided
-        if model and 'instructor_embeddings' in tables:
-            try:
-                logger.info("-" * 80)
-                logger.info("Testing instructor search")
-                test_query = "Professor who teaches Computer Science"
-                
-                # Generate embedding for test query
-                query_embedding = model.encode(test_query).tolist()
-                
-                cursor.execute("""
-                    SELECT 
-                        i.id,
-                        i.name,
-                        1 - (e.embedding <=> %s::vector) AS similarity
-                    FROM 
-                        vectors.instructor_embeddings e
-                    JOIN 
-                        trace.instructors i ON e.instructor_id = i.id
-                    ORDER BY 
-                        e.embedding <=> %s::vector
-                    LIMIT 3;
-                """, (query_embedding, query_embedding))
-                
-                results = cursor.fetchall()
-                logger.info(f"Query: {test_query}")
-                logger.info(f"Found {len(results)} similar instructors:")
-                
-                for id, name, similarity in results:
-                    logger.info(f"Instructor ID: {id}, Name: {name}, Similarity: {similarity:.4f}")
-            except Exception as e:
-                logger.warning(f"Instructor search test failed: {e}")
+                logger.warning(f"Could not count {spec.vector_table}: {e}")
                 conn.rollback()  # Reset transaction state
         
-        # Test course search if model is provided
-        if model and 'course_embeddings' in tables:
-            try:
-                logger.info("-" * 80)
-                logger.info("Testing course search")
-                test_query = "Introduction to Computer Science"
-                
-                # Generate embedding for test query
-                query_embedding = model.encode(test_query).tolist()
-                
-                cursor.execute("""
-                    SELECT 
-                        c.id,
-                        c.course_id,
-                        c.course_name,
-                        c.subject,
-                        1 - (e.embedding <=> %s::vector) AS similarity
-                    FROM 
-                        vectors.course_embeddings e
-                    JOIN 
-                        trace.courses c ON e.course_id = c.id
-                    ORDER BY 
-                        e.embedding <=> %s::vector
-                    LIMIT 3;
-                """, (query_embedding, query_embedding))
-                
-                results = cursor.fetchall()
-                logger.info(f"Query: {test_query}")
-                logger.info(f"Found {len(results)} similar courses:")
-                
-                for id, course_id, course_name, subject, similarity in results:
-                    logger.info(f"Course ID: {id}, Code: {course_id}, Name: {course_name}, Subject: {subject}, Similarity: {similarity:.4f}")
-            except Exception as e:
-                logger.warning(f"Course search test failed: {e}")
-                conn.rollback()  # Reset transaction state
+        # Comments similar to a stored comment
+        cursor.execute(f"SELECT comment_id, embedding FROM {ENTITIES['comment'].vector_table} LIMIT 1;")
+        result = cursor.fetchone()
+        if result:
+            comment_id, embedding = result
+            queries.append(Query('comment', embedding=embedding, exclude_id=comment_id))
+        conn.commit()
     
     except Exception as e:
-        logger.error(f"Error testing similarity search: {e}")
-        conn.rollback()  # Ensure transaction is reset
+        logger.warning(f"Could not sample a comment embedding: {e}")
+        conn.rollback()
     
     finally:
         cursor.close()
-
-def mark_all_for_embedding(conn):
-    """Mark all records as needing embeddings."""
-    cursor = conn.cursor()
+    
+    # Free-text searches if a model is provided
+    if model:
+        queries.append(Query('instructor', text="Professor who teaches Computer Science"))
+        queries.append(Query('course', text="Introduction to Computer Science"))
     
     try:
-        # Add embedding_needed column to tables if they don't have it
-        tables = ['comments', 'ratings', 'instructors', 'courses']
-        
-        for table in tables:
-            try:
-                cursor.execute(f"""
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_schema = 'trace' 
-                    AND table_name = '{table}' 
-                    AND column_name = 'embedding_needed';
-                """)
-                
-                if not cursor.fetchone():
-                    cursor.execute(f"""
-                        ALTER TABLE trace.{table} 
-                        ADD COLUMN IF NOT EXISTS embedding_needed BOOLEAN DEFAULT TRUE;
-                    """)
-                    logger.info(f"Added embedding_needed column to trace.{table}")
-            except Exception as e:
-                logger.warning(f"Could not add embedding_needed column to trace.{table}: {e}")
-                conn.rollback()  # Reset transaction state
-        
-        # Mark all records as needing embeddings
-        for table in tables:
-            try:
-                cursor.execute(f"UPDATE trace.{table} SET embedding_needed = TRUE;")
-                logger.info(f"Marked all records in trace.{table} for embedding")
-            except Exception as e:
-                logger.warning(f"Could not mark records in trace.{table}: {e}")
-                conn.rollback()  # Reset transaction state
-        
-        conn.commit()
-        logger.info("Marked all records as needing embeddings")
-        
+        results = search(conn, model, queries, k=3)
     except Exception as e:
-        conn.rollback()
-        logger.error(f"Error marking records for embedding: {e}")
+        logger.error(f"Error testing similarity search: {e}")
+        return
     
-    finally:
-        cursor.close()
\ No newline at end of file
+    for result in results:
+        query = result.query
+        logger.info("-" * 80)
+        if query.text is None:
+            logger.info(f"{query.entity.capitalize()}s similar to {query.entity} ID {query.exclude_id}:")
+        else:
+            logger.info(f"{query.entity.capitalize()}s similar to '{query.text}':")
+        
+        for hit in result.hits:
+            # Long text columns are shortened for the log
+            details = ', '.join(f"{column}: {str(value)[:100]}" for column, value in hit.row.items()
+                                if column != 'id' and value is not None)
+            logger.info(f"ID: {hit.id}, Similarity: {hit.similarity:.4f}, {details}")
@@ -0,0 +1,129 @@
+"""
+Long-running daemon mode.
+
+The model stays resident while the daemon waits for notifications on a Postgres
+channel. Triggers on the trace tables notify the channel whenever a row needs a
+new embedding. Notifications that arrive within a short window are handled as
+one micro-batch. The daemon also polls every poll interval, in case a
+notification was missed.
+"""
+import select
+import signal
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from config import DB_CONFIG, EMBEDDING_CONFIG, logger
+from change_tracking import _install_function, _install_trigger
+from create_embeddings import generate_embeddings
+from entities import ENTITIES
+from metrics import METRICS
+
+def install_notify_triggers(conn):
+    """Create triggers that notify the daemon channel when rows need embeddings."""
+    cursor = conn.cursor()
+    channel = EMBEDDING_CONFIG['daemon']['channel']
+    function = f"{EMBEDDING_CONFIG['schema']['vector']}.notify_embedding_needed"
+    
+    try:
+        # Unchanged functions and triggers are left alone, so busy source
+        # tables are not locked on every start
+        _install_function(cursor, function, f"""
+            BEGIN
+                -- Identical notifications are folded into one per transaction
+                PERFORM pg_notify('{channel}', TG_TABLE_NAME);
+                RETURN NULL;
+            END;
+        """)
+        
+        for spec in ENTITIES.values():
+            _install_trigger(cursor, 'notify_embedding_needed', spec.source, f"""
+                AFTER INSERT OR UPDATE ON {spec.source}
+                FOR EACH ROW
+                WHEN (NEW.embedding_needed IS NOT FALSE)
+                EXECUTE FUNCTION {function}()
+            """)
+        
+        conn.commit()
+        logger.info(f"Installed embedding notification triggers on channel '{channel}'")
+    
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Could not install embedding notification triggers, relying on polling: {e}")
+    
+    finally:
+        cursor.close()
+
+def _listen():
+    """Open an autocommit connection listening on the daemon channel."""
+    listen_conn = psycopg2.connect(**DB_CONFIG)
+    listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = listen_conn.cursor()
+    cursor.execute(f"LISTEN {EMBEDDING_CONFIG['daemon']['channel']};")
+    cursor.close()
+    return listen_conn
+
+def _drain_notifications(listen_conn, entities, pending):
+    """Add the entity types named by received notifications to pending."""
+    listen_conn.poll()
+    while listen_conn.notifies:
+        notify = listen_conn.notifies.pop(0)
+        entity = next((spec.name for spec in ENTITIES.values() if spec.source_table == notify.payload), None)
+        if entity in entities:
+            pending.add(entity)
+
+def run_daemon(conn, model, entities):
+    """
+    Keep embedding new and changed rows until SIGTERM or SIGINT is received.
+    
+    Returns a dict of processed counts per entity type over the daemon's lifetime.
+    """
+    config = EMBEDDING_CONFIG['daemon']
+    stop = threading.Event()
+    totals = {entity: 0 for entity in entities}
+    
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, stopping daemon")
+        stop.set()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    install_notify_triggers(conn)
+    listen_conn = _listen()
+    logger.info(f"Daemon listening on channel '{config['channel']}', polling every {config['poll_interval']}s")
+    
+    # Drain whatever is already pending before waiting for notifications
+    pending = set(entities)
+    last_poll = time.monotonic()
+    
+    try:
+        while not stop.is_set():
+            if pending:
+                # Give related changes a moment to arrive so they share a micro-batch
+                deadline = time.monotonic() + config['batch_window']
+                while not stop.is_set() and time.monotonic() < deadline:
+                    if select.select([listen_conn], [], [], max(0, deadline - time.monotonic()))[0]:
+                        _drain_notifications(listen_conn, entities, pending)
+                
+                for entity in [e for e in entities if e in pending]:
+                    count = generate_embeddings(conn, model, ENTITIES[entity])
+                    totals[entity] += count
+                    if count:
+                        logger.info(f"Generated embeddings for {count} {entity}s")
+                pending.clear()
+                METRICS.write_textfile()
+            
+            timeout = max(0, config['poll_interval'] - (time.monotonic() - last_poll))
+            if select.select([listen_conn], [], [], min(timeout, 1.0))[0]:
+                _drain_notifications(listen_conn, entities, pending)
+            elif time.monotonic() - last_poll >= config['poll_interval']:
+                # Fallback in case notifications were missed
+                pending.update(entities)
+                last_poll = time.monotonic()
+    
+    finally:
+        listen_conn.close()
+        logger.info("Daemon stopped")
+    
+    return totals
@@ -0,0 +1,90 @@
+"""
+Database connection helpers for the embedding service.
+
+Connections are opened with pgvector's types registered: NumPy arrays are sent
+as vector parameters without converting them to Python lists, and vector
+columns are read back as NumPy float32 arrays. Bulk writes of embeddings use
+binary COPY, sending the float32 buffers as they are.
+"""
+import io
+import struct
+import numpy as np
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
+from config import DB_CONFIG, logger
+
+# Header and trailer of the binary COPY format
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_TRAILER = struct.pack('!h', -1)
+
+def register_types(conn):
+    """Register the pgvector types on a connection."""
+    register_vector(conn)
+    # The type lookup opened a transaction
+    conn.commit()
+    return conn
+
+def connect():
+    """Open a new connection with the pgvector types registered."""
+    return register_types(psycopg2.connect(**DB_CONFIG))
+
+class VectorConnectionPool(ThreadedConnectionPool):
+    """Connection pool whose connections have the pgvector types registered."""
+    
+    def _connect(self, key=None):
+        return register_types(super()._connect(key))
+
+# Shared pool used when stages run concurrently; None means one connection per caller
+_pool = None
+
+def init_pool(minconn, maxconn):
+    """Create the shared, thread-safe connection pool."""
+    global _pool
+    _pool = VectorConnectionPool(minconn, maxconn, **DB_CONFIG)
+    logger.info(f"Created connection pool with up to {maxconn} connections")
+
+def close_pool():
+    """Close all connections of the shared pool."""
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+def get_connection():
+    """Get a connection from the shared pool, or open a new one if there is no pool."""
+    if _pool is not None:
+        return _pool.getconn()
+    return connect()
+
+def release_connection(conn):
+    """Return a connection obtained with get_connection."""
+    if _pool is not None:
+        _pool.putconn(conn)
+    else:
+        conn.close()
+
+def copy_embeddings(cursor, table, id_column, rows):
+    """
+    Bulk-load (id, embedding, text_hash) rows into a table with binary COPY.
+    
+    The table's columns must be ({id_column} BIGINT, embedding vector,
+    text_hash TEXT). Embeddings are written in pgvector's binary format: the
+    dimension, an unused field and the big-endian float32 values.
+    """
+    buffer = io.BytesIO()
+    buffer.write(_COPY_HEADER)
+    for entity_id, embedding, h in rows:
+        values = np.asarray(embedding, dtype='>f4')
+        buffer.write(struct.pack('!hiq', 3, 8, entity_id))
+        buffer.write(struct.pack('!ihh', 4 + values.nbytes, len(values), 0))
+        buffer.write(values.tobytes())
+        if h is None:
+            buffer.write(struct.pack('!i', -1))
+        else:
+            encoded = h.encode('utf-8')
+            buffer.write(struct.pack('!i', len(encoded)))
+            buffer.write(encoded)
+    buffer.write(_COPY_TRAILER)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({id_column}, embedding, text_hash) FROM STDIN WITH (FORMAT BINARY)", buffer)
@@ -0,0 +1,91 @@
+"""
+Content-hash cache of embeddings, keyed on (model version, hash of the composed text).
+
+The model_name column holds backends.model_version(), so a new revision or
+dimension of the same model does not reuse its predecessor's embeddings.
+"""
+import hashlib
+from psycopg2.extras import execute_values
+from config import EMBEDDING_CONFIG, logger
+from backends import model_version
+
+def cache_table():
+    """Fully qualified name of the embedding cache table."""
+    return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables']['cache']}"
+
+def text_hash(text):
+    """Hash of a composed embedding text."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def ensure_embedding_cache(conn):
+    """Create the embedding cache table if it does not exist."""
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {cache_table()} (
+                model_name TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding vector NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (model_name, text_hash)
+            );
+        """)
+        conn.commit()
+        logger.info(f"Embedding cache table {cache_table()} is ready")
+    
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Could not create embedding cache table {cache_table()}: {e}")
+    
+    finally:
+        cursor.close()
+
+def lookup_cached_embeddings(conn, hashes):
+    """Return a {text_hash: embedding} dict of the hashes cached for the current model."""
+    if not hashes:
+        return {}
+    
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            SELECT text_hash, embedding
+            FROM {cache_table()}
+            WHERE model_name = %s AND text_hash = ANY(%s);
+        """, (model_version(), list(hashes)))
+        
+        # Embeddings come back as NumPy arrays through the registered pgvector types
+        cached = dict(cursor.fetchall())
+        conn.commit()
+        return cached
+    
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Embedding cache lookup failed, encoding without cache: {e}")
+        return {}
+    
+    finally:
+        cursor.close()
+
+def store_cached_embeddings(cursor, entries):
+    """
+    Insert (text_hash, embedding) pairs into the cache.
+    
+    Runs on the caller's cursor so the entries commit together with the
+    embeddings they were computed for.
+    """
+    if not entries:
+        return
+    
+    unique_entries = dict(entries)
+    execute_values(
+        cursor,
+        f"""
+            INSERT INTO {cache_table()} (model_name, text_hash, embedding)
+            VALUES %s
+            ON CONFLICT (model_name, text_hash) DO NOTHING
+        """,
+        [(model_version(), h, embedding) for h, embedding in unique_entries.items()],
+        page_size=len(unique_entries)
+    )
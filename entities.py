@@ -0,0 +1,205 @@
+"""
+Declarative specs of the entity types that get embeddings.
+
+Each spec describes where candidate rows come from, how their embedding text is
+composed and which vectors table receives the embeddings. The embedding engine
+in create_embeddings.py runs any spec, so a new entity type (for example
+per-question aggregates) only needs a new entry in ENTITIES.
+"""
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+from config import EMBEDDING_CONFIG
+
+@dataclass(frozen=True)
+class Dependency:
+    """
+    A table, other than the source table, that an entity's text is joined from.
+    
+    ids selects the ids of the entity rows affected by a changed row of the
+    table, referenced as `{row}`; `{source}` is replaced with the source schema.
+    columns limits the dependency to updates of the columns used in the text;
+    without it, inserts, updates and deletes all count.
+    """
+    table: str
+    ids: str
+    columns: Optional[Tuple[str, ...]] = None
+
+@dataclass(frozen=True)
+class Aggregate:
+    """
+    A text column aggregated over joined tables, precomputed per entity row.
+    
+    expression is evaluated over the source table (under the spec's alias) and
+    joins, grouped by the row id. The results are kept in the spec's aggregate
+    table and are available to the candidate query as `agg.<column>`.
+    """
+    column: str
+    expression: str
+    joins: str
+
+@dataclass(frozen=True)
+class EntitySpec:
+    """
+    How to embed one entity type.
+    
+    Candidate rows are selected as
+    SELECT <alias>.id, <row version>, <columns> FROM <source schema>.<source_table> <alias> <joins>,
+    grouped by <alias>.id plus group_by when given. `{source}` in columns and
+    joins is replaced with the source schema. The selected columns, in order,
+    are passed to compose_text. The row version (the row's xmin) lets writers
+    leave rows flagged that changed after they were read.
+    
+    chunk_field is the index (among the selected columns) of a long free-text
+    column that may be split into windows when chunking is enabled.
+    dependencies lists the joined tables whose changes alter the text, and
+    aggregate a precomputed column joined in as `agg`. A shadow spec writes to
+    the entity's shadow tables instead of the live ones (see shadow.py).
+    """
+    name: str
+    source_table: str
+    alias: str
+    columns: str
+    compose_text: Callable[..., str]
+    joins: str = ''
+    group_by: Optional[str] = None
+    chunk_field: Optional[int] = None
+    dependencies: Tuple[Dependency, ...] = ()
+    aggregate: Optional[Aggregate] = None
+    shadow: bool = False
+    
+    @property
+    def vector_table(self):
+        """Fully qualified table receiving the embeddings."""
+        suffix = '_shadow' if self.shadow else ''
+        return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables'][self.name]}{suffix}"
+    
+    @property
+    def source(self):
+        """Fully qualified source table."""
+        return f"{EMBEDDING_CONFIG['schema']['source']}.{self.source_table}"
+    
+    @property
+    def chunk_table(self):
+        """Fully qualified side table receiving per-chunk embeddings."""
+        suffix = '_shadow' if self.shadow else ''
+        return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables'][f'{self.name}_chunk']}{suffix}"
+    
+    @property
+    def neighbors_table(self):
+        """Fully qualified table holding the precomputed nearest neighbours."""
+        return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables'][f'{self.name}_neighbors']}"
+    
+    @property
+    def aggregate_table(self):
+        """Fully qualified table holding the precomputed aggregate column."""
+        return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables'][f'{self.name}_aggregate']}"
+    
+    @property
+    def id_column(self):
+        """Column of the vectors table referencing the source row."""
+        return f"{self.name}_id"
+    
+    def candidate_query(self, pending_only=True, where=None):
+        """
+        Keyset-paginated query for the rows that need embeddings, or for all
+        rows; where optionally narrows it with a condition on the alias.
+        """
+        schema = EMBEDDING_CONFIG['schema']['source']
+        a = self.alias
+        group_by = f"GROUP BY {a}.id, {a}.xmin::text, {self.group_by}" if self.group_by else ''
+        joins = self.joins.format(source=schema)
+        if self.aggregate:
+            # Rows whose aggregate was invalidated wait for the next refresh
+            joins = f"JOIN {self.aggregate_table} agg ON agg.{self.id_column} = {a}.id {joins}".rstrip()
+        
+        pending = f"{a}.embedding_needed IS NOT FALSE" if pending_only else 'TRUE'
+        if where:
+            pending = f"{pending} AND ({where})"
+        
+        return f"""
+            SELECT {a}.id, {a}.xmin::text, {self.columns.format(source=schema)}
+            FROM {self.source} {a}
+            {joins}
+            WHERE {pending}
+              AND (%(last_id)s IS NULL OR {a}.id > %(last_id)s)
+              AND (%(max_id)s IS NULL OR {a}.id <= %(max_id)s)
+            {group_by}
+            ORDER BY {a}.id
+            LIMIT %(fetch_size)s;
+        """
+
+def compose_comment_text(question_text, comment_text, category):
+    """Build the embedding text for a comment."""
+    return f"Question: {question_text}. Comment: {comment_text}. Category: {category}"
+
+def compose_rating_text(question_text, category, course_mean):
+    """Build the embedding text for a rating - include score for better semantic understanding."""
+    return f"Question: {question_text}. Category: {category}. Score: {course_mean}/5.0"
+
+def compose_instructor_text(name, courses):
+    """Build the embedding text for an instructor."""
+    return f"Instructor: {name}. Teaches courses: {courses or 'None'}"
+
+def compose_course_text(course_code, course_name, subject, catalog_section, semester, year, enrollment, responses, instructors):
+    """Build the embedding text for a course."""
+    return (f"Course code: {course_code} Course name: {course_name}. "
+            f"Subject: {subject}. Section: {catalog_section}. "
+            f"Term: {semester} {year}. "
+            f"Enrollment: {enrollment} students, {responses} responses. "
+            f"Instructors: {instructors or 'None'}")
+
+# Entity types that get embeddings, keyed by entity name
+ENTITIES = {
+    'comment': EntitySpec(
+        name='comment',
+        source_table='comments',
+        alias='cm',
+        columns='cm.question_text, cm.comment_text, cm.category',
+        compose_text=compose_comment_text,
+        chunk_field=1,
+    ),
+    'rating': EntitySpec(
+        name='rating',
+        source_table='ratings',
+        alias='r',
+        columns='r.question_text, r.category, r.course_mean',
+        compose_text=compose_rating_text,
+    ),
+    'instructor': EntitySpec(
+        name='instructor',
+        source_table='instructors',
+        alias='i',
+        columns='i.name, agg.courses',
+        compose_text=compose_instructor_text,
+        aggregate=Aggregate(
+            column='courses',
+            expression="string_agg(DISTINCT c.course_id || ': ' || c.course_name || ' (' || c.semester || ' ' || c.year || ')', ' | ')",
+            joins="""LEFT JOIN {source}.course_instructors ci ON i.id = ci.instructor_id
+                LEFT JOIN {source}.courses c ON ci.course_id = c.id""",
+        ),
+        dependencies=(
+            Dependency('course_instructors', 'SELECT {row}.instructor_id'),
+            Dependency('courses', 'SELECT instructor_id FROM {source}.course_instructors WHERE course_id = {row}.id',
+                       columns=('course_id', 'course_name', 'semester', 'year')),
+        ),
+    ),
+    'course': EntitySpec(
+        name='course',
+        source_table='courses',
+        alias='c',
+        columns="""c.course_id, c.course_name, c.subject, c.catalog_section,
+                   c.semester, c.year, c.enrollment, c.responses, agg.instructors""",
+        compose_text=compose_course_text,
+        aggregate=Aggregate(
+            column='instructors',
+            expression="string_agg(DISTINCT i.name, ', ')",
+            joins="""LEFT JOIN {source}.course_instructors ci ON c.id = ci.course_id
+                LEFT JOIN {source}.instructors i ON ci.instructor_id = i.id""",
+        ),
+        dependencies=(
+            Dependency('course_instructors', 'SELECT {row}.course_id'),
+            Dependency('instructors', 'SELECT course_id FROM {source}.course_instructors WHERE instructor_id = {row}.id',
+                       columns=('name',)),
+        ),
+    ),
+}
@@ -0,0 +1,97 @@
+"""
+Approximate nearest neighbour (ANN) index management for the embedding tables.
+
+Indexes use pgvector's HNSW or IVFFlat access methods with cosine distance,
+matching the `<=>` operator used by the similarity queries. With a compact
+storage precision, the index is built on the compact column instead (see
+quantization.py).
+"""
+from config import EMBEDDING_CONFIG, logger
+from quantization import COMPACT_COLUMN, index_target
+
+INDEX_TYPES = ('hnsw', 'ivfflat')
+
+# Upper bound pgvector accepts for hnsw.ef_search
+HNSW_MAX_EF_SEARCH = 1000
+
+def _table(entity, suffix=''):
+    """Fully qualified embedding table of an entity type; suffix selects e.g. its shadow table."""
+    return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables'][entity]}{suffix}"
+
+def _index_name(entity, index_type, column='embedding', suffix=''):
+    return f"{EMBEDDING_CONFIG['tables'][entity]}{suffix}_{column}_{index_type}_idx"
+
+def drop_indexes(conn, entities):
+    """Drop the ANN indexes of the given entity types, e.g. before a bulk load."""
+    cursor = conn.cursor()
+    
+    try:
+        for entity in entities:
+            for index_type in INDEX_TYPES:
+                for column in ('embedding', COMPACT_COLUMN):
+                    cursor.execute(f"DROP INDEX IF EXISTS {EMBEDDING_CONFIG['schema']['vector']}.{_index_name(entity, index_type, column)};")
+            logger.info(f"Dropped ANN indexes on {_table(entity)}")
+        conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Could not drop ANN indexes: {e}")
+    
+    finally:
+        cursor.close()
+
+def create_indexes(conn, entities, suffix=''):
+    """Create the configured ANN index on each entity type's table (or its shadow, with suffix) if it does not exist."""
+    config = EMBEDDING_CONFIG['index']
+    index_type = config['type']
+    if index_type == 'none':
+        return
+    
+    column, ops = index_target()
+    if index_type == 'hnsw':
+        method = f"hnsw ({column} {ops}) WITH (m = {config['hnsw_m']}, ef_construction = {config['hnsw_ef_construction']})"
+    else:
+        method = f"ivfflat ({column} {ops}) WITH (lists = {config['ivfflat_lists']})"
+    
+    schema = EMBEDDING_CONFIG['schema']['vector']
+    cursor = conn.cursor()
+    
+    try:
+        # Built CONCURRENTLY, outside a transaction, so writers are not blocked
+        conn.commit()
+        conn.autocommit = True
+        # More memory keeps the graph build in RAM, which is much faster
+        cursor.execute("SET maintenance_work_mem = %s;", (config['maintenance_work_mem'],))
+        
+        for entity in entities:
+            name = _index_name(entity, index_type, column, suffix)
+            try:
+                # An interrupted concurrent build leaves an invalid index behind
+                cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (f"{schema}.{name}",))
+                row = cursor.fetchone()
+                if row and not row[0]:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {schema}.{name};")
+                cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {_table(entity, suffix)} USING {method};")
+                logger.info(f"{index_type} index on {_table(entity, suffix)} is ready")
+            except Exception as e:
+                logger.warning(f"Could not create {index_type} index on {_table(entity, suffix)}: {e}")
+        
+        cursor.execute("RESET maintenance_work_mem;")
+    
+    finally:
+        conn.autocommit = False
+        cursor.close()
+
+def configure_search(cursor, candidates=0):
+    """
+    Set the ANN search parameters for the queries of the cursor's transaction.
+    
+    An HNSW scan returns at most ef_search rows, so ef_search is raised to the
+    number of candidates the query takes from the index.
+    """
+    config = EMBEDDING_CONFIG['index']
+    ef_search = min(max(config['hnsw_ef_search'], candidates), HNSW_MAX_EF_SEARCH)
+    if candidates > ef_search:
+        logger.warning(f"Only {ef_search} of {candidates} search candidates can come from an HNSW index")
+    cursor.execute("SET LOCAL hnsw.ef_search = %s;", (ef_search,))
+    cursor.execute("SET LOCAL ivfflat.probes = %s;", (config['ivfflat_probes'],))
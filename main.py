@@ -1,15 +1,25 @@
 import psycopg2
 import argparse
-from sentence_transformers import SentenceTransformer
-from config import DB_CONFIG, EMBEDDING_CONFIG, logger
+from config import EMBEDDING_CONFIG, logger
 from create_embeddings import (
-    generate_comment_embeddings, 
-    generate_rating_embeddings,
-    generate_instructor_embeddings,
-    generate_course_embeddings,
-    test_similarity_search,
-    mark_all_for_embedding
+    generate_embeddings,
+    test_similarity_search
 )
+from backends import LazyModel, model_version, sample_texts, check_backend_agreement
+from daemon import run_daemon
+from aggregates import ensure_aggregate_tables
+from change_tracking import install_change_tracking
+from embedding_cache import ensure_embedding_cache
+from chunking import ensure_chunk_tables
+from entities import ENTITIES
+from db import connect
+from indexes import drop_indexes, create_indexes
+from quantization import ensure_compact_columns
+from rebuild import ensure_checkpoint_table, plan_rebuild, rebuild_entity, rebuild_progress
+from shadow import shadow_embeddings, cutover, rollback
+from snapshot import export_snapshot, write_neighbors
+from metrics import METRICS
+from workers import run_sharded, run_parallel
 
 def main():
     """Main function for pgvector embeddings."""
@@ -21,25 +31,50 @@ def main():
     parser.add_argument('--ratings', action='store_true', help='Only process ratings')
     parser.add_argument('--instructors', action='store_true', help='Only process instructors')
     parser.add_argument('--courses', action='store_true', help='Only process courses')
+    parser.add_argument('--check-backend', action='store_true', help='Compare the configured backend against torch on a sample and exit')
+    parser.add_argument('--serve', action='store_true', help='Run the HTTP server for query embeddings and search')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and embed new or changed rows as they arrive')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes used for encoding')
+    parser.add_argument('--export-snapshot', action='store_true', help='Export memory-mapped embedding snapshots to SNAPSHOT_DIR and exit')
+    parser.add_argument('--neighbors', type=int, metavar='K', help='Export snapshots, store the K nearest neighbours of every row and exit')
+    parser.add_argument('--parallel', action='store_true', help='Process the content types concurrently')
+    parser.add_argument('--shadow', action='store_true', help='Re-embed everything with the configured model into shadow tables and exit')
+    parser.add_argument('--cutover', action='store_true', help='Switch the finished shadow tables in and exit')
+    parser.add_argument('--rollback', action='store_true', help='Switch the tables replaced by the last cutover back in and exit')
     args = parser.parse_args()
     
-    # Load the embedding model
-    logger.info("Loading embedding model...")
-    model = SentenceTransformer(EMBEDDING_CONFIG['model_name'])
-    logger.info(f"Model {EMBEDDING_CONFIG['model_name']} loaded successfully")
+    # The model is loaded on first use, so runs with nothing to encode start fast
+    model = LazyModel()
     
     # Connect to database
     logger.info("Connecting to PostgreSQL...")
     conn = None
     
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        # A model that does not match the configuration fails here, not on
+        # every chunk labelled with its version
+        logger.info(f"Embedding model {model_version()}")
+        conn = connect()
         logger.info("Connected to database successfully")
         
-        # Mark all records for embedding if rebuild flag is set
-        if args.rebuild:
-            mark_all_for_embedding(conn)
-            logger.info("Marked all records for embedding regeneration")
+        # Triggers, pending indexes and text hashes used to find changed rows
+        offline = args.export_snapshot or args.neighbors
+        if not (args.check_backend or args.serve or args.test or offline):
+            install_change_tracking(conn)
+            ensure_aggregate_tables(conn)
+        
+        # Compare the configured backend against torch and exit
+        if args.check_backend:
+            check_backend_agreement(model, sample_texts(conn))
+            return
+        
+        # Serve query embeddings and searches over HTTP
+        if args.serve:
+            # Flask is only needed in server mode
+            from server import serve
+            # Load and warm up before accepting requests
+            serve(model.load())
+            return
         
         # If test flag is set, only run the similarity search test
         if args.test:
@@ -47,31 +82,75 @@ def main():
             test_similarity_search(conn, model)
             return
         
+        if EMBEDDING_CONFIG['cache_enabled']:
+            ensure_embedding_cache(conn)
+        
         # Process each content type based on arguments or process all if none specified
         process_all = not any([args.comments, args.ratings, args.instructors, args.courses])
+        entities = [entity for entity in ENTITIES if process_all or getattr(args, f"{entity}s", False)]
         
-        # Track total processed counts
-        total_processed = 0
+        # Exact similarity over snapshots, without touching the embeddings
+        if offline:
+            for entity in entities:
+                export_snapshot(conn, entity)
+                if args.neighbors:
+                    write_neighbors(conn, entity, args.neighbors)
+            return
         
-        if process_all or args.comments:
-            num_comments = generate_comment_embeddings(conn, model)
-            logger.info(f"Generated embeddings for {num_comments} comments")
-            total_processed += num_comments
+        ensure_compact_columns(conn, entities)
         
-        if process_all or args.ratings:
-            num_ratings = generate_rating_embeddings(conn, model)
-            logger.info(f"Generated embeddings for {num_ratings} ratings")
-            total_processed += num_ratings
+        if EMBEDDING_CONFIG['chunking']['enabled'] and EMBEDDING_CONFIG['chunking']['store_chunks']:
+            ensure_chunk_tables(conn, entities)
         
-        if process_all or args.instructors:
-            num_instructors = generate_instructor_embeddings(conn, model)
-            logger.info(f"Generated embeddings for {num_instructors} instructors")
-            total_processed += num_instructors
+        # Change models through shadow tables while production keeps the live ones
+        if args.shadow or args.cutover or args.rollback:
+            ensure_checkpoint_table(conn)
+            if args.cutover:
+                cutover(conn, entities)
+            elif args.rollback:
+                rollback(conn, entities)
+            else:
+                for entity in entities:
+                    count = shadow_embeddings(conn, model, entity)
+                    logger.info(f"Stored {count} {entity} embeddings in the shadow table")
+            return
         
-        if process_all or args.courses:
-            num_courses = generate_course_embeddings(conn, model)
-            logger.info(f"Generated embeddings for {num_courses} courses")
-            total_processed += num_courses
+        # Keep the model resident and embed rows as they arrive
+        if args.daemon:
+            create_indexes(conn, entities)
+            run_daemon(conn, model.load(), entities)
+            return
+        
+        # Re-encode every row in checkpointed id ranges, resuming an
+        # interrupted rebuild; bulk loads are much faster without ANN indexes
+        # to maintain, so they are rebuilt once all embeddings are written
+        if args.rebuild:
+            ensure_checkpoint_table(conn)
+            for entity in entities:
+                plan_rebuild(conn, ENTITIES[entity])
+            drop_indexes(conn, entities)
+        
+        if args.workers > 1:
+            logger.info(f"Generating embeddings with {args.workers} worker processes")
+            counts = run_sharded(conn, entities, args.workers, args.rebuild)
+        elif args.parallel:
+            logger.info(f"Generating embeddings for {len(entities)} content types in parallel")
+            counts = run_parallel(entities, model, args.rebuild)
+        elif args.rebuild:
+            counts = {entity: rebuild_entity(conn, model, ENTITIES[entity]) for entity in entities}
+        else:
+            counts = {entity: generate_embeddings(conn, model, ENTITIES[entity]) for entity in entities}
+        
+        for entity, count in counts.items():
+            logger.info(f"Generated embeddings for {count} {entity}s")
+            if args.rebuild:
+                done, total = rebuild_progress(conn, ENTITIES[entity])
+                logger.info(f"{entity.capitalize()} rebuild: {done} of {total} id ranges done")
+        
+        create_indexes(conn, entities)
+        
+        # Track total processed counts
+        total_processed = sum(counts.values())
         
         # Test similarity search if we generated any embeddings
         if total_processed > 0:
@@ -84,6 +163,8 @@ def main():
         logger.error(f"Error in main function: {e}")
     
     finally:
+        METRICS.log_summary()
+        METRICS.write_textfile()
         if conn is not None:
             conn.close()
             logger.info("Database connection closed")
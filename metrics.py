@@ -0,0 +1,172 @@
+"""
+Run metrics for the embedding service.
+
+Records time spent per pipeline stage (fetch, compose, cache lookup, encode,
+write, commit), row counts, batch sizes, retries and errors per entity type.
+Metrics are rendered in the Prometheus text exposition format, either as a
+textfile for node_exporter or through the query server's /metrics endpoint,
+and summarised as a table at exit.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from config import EMBEDDING_CONFIG, logger
+
+STAGES = ('fetch', 'compose', 'cache_lookup', 'encode', 'write', 'commit')
+
+# Reference point for time-to-first-embedding; this module is imported at startup
+PROCESS_START = time.perf_counter()
+
+# Upper bounds of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Metrics:
+    """Thread-safe collection of counters, stage timings and batch size histograms."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Process-level values such as startup times; kept across resets
+        self.gauges = {}
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(float)      # (name, entity) -> value
+            self.stage_seconds = defaultdict(float)  # (entity, stage) -> seconds
+            self.batch_sizes = defaultdict(lambda: [0] * (len(BATCH_SIZE_BUCKETS) + 1))
+            self.batch_size_sums = defaultdict(float)
+    
+    def inc(self, name, entity, value=1):
+        """Increment a counter such as rows_written, retries or errors."""
+        with self._lock:
+            self.counters[(name, entity)] += value
+    
+    def set_gauge(self, name, value):
+        """Set a process-level gauge such as time_to_first_embedding_seconds."""
+        with self._lock:
+            self.gauges[name] = value
+    
+    def add_time(self, entity, stage, seconds):
+        with self._lock:
+            self.stage_seconds[(entity, stage)] += seconds
+    
+    @contextmanager
+    def timer(self, entity, stage):
+        """Time a block of work and attribute it to a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(entity, stage, time.perf_counter() - start)
+    
+    def observe_batch(self, entity, size):
+        """Record the size of an encoded batch."""
+        with self._lock:
+            buckets = self.batch_sizes[entity]
+            for i, bound in enumerate(BATCH_SIZE_BUCKETS):
+                if size <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+            self.batch_size_sums[entity] += size
+    
+    def snapshot(self):
+        """Plain-dict copy of all metrics, e.g. to send back from a worker process."""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'stage_seconds': dict(self.stage_seconds),
+                'batch_sizes': {entity: list(buckets) for entity, buckets in self.batch_sizes.items()},
+                'batch_size_sums': dict(self.batch_size_sums),
+                'gauges': dict(self.gauges),
+            }
+    
+    def merge(self, snapshot):
+        """Add a snapshot taken in another process to these metrics."""
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] += value
+            for key, value in snapshot['stage_seconds'].items():
+                self.stage_seconds[key] += value
+            for entity, buckets in snapshot['batch_sizes'].items():
+                merged = self.batch_sizes[entity]
+                for i, count in enumerate(buckets):
+                    merged[i] += count
+            for entity, value in snapshot['batch_size_sums'].items():
+                self.batch_size_sums[entity] += value
+            # Keep the slowest worker's startup times
+            for name, value in snapshot['gauges'].items():
+                self.gauges[name] = max(value, self.gauges.get(name, value))
+    
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        
+        names = sorted({name for name, _ in snapshot['counters']})
+        for name in names:
+            lines.append(f"# TYPE embedding_{name}_total counter")
+            for (counter, entity), value in sorted(snapshot['counters'].items()):
+                if counter == name:
+                    lines.append(f'embedding_{name}_total{{entity="{entity}"}} {value:g}')
+        
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f"# TYPE embedding_{name} gauge")
+            lines.append(f"embedding_{name} {value:.6f}")
+        
+        lines.append("# TYPE embedding_stage_seconds_total counter")
+        for (entity, stage), seconds in sorted(snapshot['stage_seconds'].items()):
+            lines.append(f'embedding_stage_seconds_total{{entity="{entity}",stage="{stage}"}} {seconds:.6f}')
+        
+        lines.append("# TYPE embedding_batch_size histogram")
+        for entity, buckets in sorted(snapshot['batch_sizes'].items()):
+            cumulative = 0
+            for bound, count in zip(BATCH_SIZE_BUCKETS, buckets):
+                cumulative += count
+                lines.append(f'embedding_batch_size_bucket{{entity="{entity}",le="{bound}"}} {cumulative}')
+            cumulative += buckets[-1]
+            lines.append(f'embedding_batch_size_bucket{{entity="{entity}",le="+Inf"}} {cumulative}')
+            lines.append(f'embedding_batch_size_sum{{entity="{entity}"}} {snapshot["batch_size_sums"][entity]:g}')
+            lines.append(f'embedding_batch_size_count{{entity="{entity}"}} {cumulative}')
+        
+        return '\n'.join(lines) + '\n'
+    
+    def write_textfile(self, path=None):
+        """Atomically write the metrics to a Prometheus textfile, if one is configured."""
+        path = path or EMBEDDING_CONFIG['metrics_textfile']
+        if not path:
+            return
+        
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Could not write metrics textfile {path}: {e}")
+    
+    def log_summary(self):
+        """Log a per-entity summary table of rows, throughput and stage timings."""
+        snapshot = self.snapshot()
+        entities = sorted({entity for _, entity in snapshot['counters']} |
+                          {entity for entity, _ in snapshot['stage_seconds']})
+        if not entities:
+            return
+        
+        header = f"{'entity':<12}{'rows':>10}{'rows/s':>10}" + ''.join(f"{stage:>14}" for stage in STAGES) + f"{'retries':>9}{'errors':>8}"
+        logger.info("Embedding run summary (stage times in seconds):")
+        logger.info(header)
+        for entity in entities:
+            rows = snapshot['counters'].get(('rows_written', entity), 0)
+            total = snapshot['stage_seconds'].get((entity, 'total'), 0)
+            rate = f"{rows / total:.1f}" if total else '-'
+            stages = ''.join(f"{snapshot['stage_seconds'].get((entity, stage), 0):>14.2f}" for stage in STAGES)
+            logger.info(f"{entity:<12}{rows:>10g}{rate:>10}{stages}"
+                        f"{snapshot['counters'].get(('retries', entity), 0):>9g}"
+                        f"{snapshot['counters'].get(('errors', entity), 0):>8g}")
+
+# Process-wide metrics
+METRICS = Metrics()
@@ -0,0 +1,148 @@
+"""
+Compact storage of embeddings for search.
+
+Besides the full-precision `embedding` column, each vectors table can carry a
+compact copy in `embedding_compact`: pgvector halfvec (half the size) or binary
+quantization (one bit per dimension, 1/32 of the size). The compact column is a
+generated column, so writers are unchanged, and it carries the ANN index.
+Searches take the nearest candidates by the compact column and re-rank them
+against the full-precision embeddings.
+"""
+from config import EMBEDDING_CONFIG, logger
+
+COMPACT_COLUMN = 'embedding_compact'
+
+# Column type, generation expression, index operator class, distance operator
+# and query expression of each compact precision
+PRECISIONS = {
+    'fp32': None,
+    'halfvec': {
+        'type': 'halfvec({dim})',
+        'expression': 'embedding::halfvec({dim})',
+        'ops': 'halfvec_cosine_ops',
+        'distance': '<=>',
+        'query': '{embedding}::halfvec({dim})',
+    },
+    'binary': {
+        'type': 'bit({dim})',
+        'expression': 'binary_quantize(embedding)::bit({dim})',
+        'ops': 'bit_hamming_ops',
+        'distance': '<~>',
+        'query': 'binary_quantize({embedding})::bit({dim})',
+    },
+}
+
+def compact_precision():
+    """Settings of the configured compact precision, or None for full precision only."""
+    precision = EMBEDDING_CONFIG['storage']['precision']
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown storage precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+    settings = PRECISIONS[precision]
+    if settings is None:
+        return None
+    return {key: value.format(dim=EMBEDDING_CONFIG['embedding_dim'], embedding='{embedding}') for key, value in settings.items()}
+
+def index_target():
+    """Column and operator class the ANN indexes are built on."""
+    settings = compact_precision()
+    if settings is None:
+        return 'embedding', 'vector_cosine_ops'
+    return COMPACT_COLUMN, settings['ops']
+
+def add_compact_column(cursor, table):
+    """Add the configured compact column to a table that has none."""
+    settings = compact_precision()
+    if settings:
+        cursor.execute(f"""
+            ALTER TABLE {table}
+            ADD COLUMN {COMPACT_COLUMN} {settings['type']}
+            GENERATED ALWAYS AS ({settings['expression']}) STORED;
+        """)
+        logger.info(f"Added {settings['type']} column {COMPACT_COLUMN} to {table}")
+
+def ensure_compact_columns(conn, entities):
+    """Add, replace or drop the compact column of each entity type's table to match the configuration."""
+    from entities import ENTITIES
+    
+    settings = compact_precision()
+    cursor = conn.cursor()
+    
+    try:
+        for entity in entities:
+            table = ENTITIES[entity].vector_table
+            cursor.execute("""
+                SELECT format_type(atttypid, atttypmod)
+                FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped;
+            """, (table, COMPACT_COLUMN))
+            row = cursor.fetchone()
+            current = row[0] if row else None
+            
+            if settings and current == settings['type']:
+                continue
+            if current is not None:
+                # Derived data; its indexes go with it
+                cursor.execute(f"ALTER TABLE {table} DROP COLUMN {COMPACT_COLUMN};")
+                logger.info(f"Dropped {current} column {COMPACT_COLUMN} from {table}")
+            add_compact_column(cursor, table)
+            conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error preparing compact embedding columns: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def nearest_query(spec, embedding, where=''):
+    """
+    SQL (without terminator) for the %(k)s nearest rows of an entity's table to
+    the vector expression embedding, as (id, similarity) rows.
+    
+    With a compact precision, the %(candidates)s nearest rows by the compact
+    column are re-ranked at full precision. where is an optional filter on the
+    vectors table.
+    """
+    settings = compact_precision()
+    where = f"WHERE {where}" if where else ''
+    
+    if settings is None:
+        return f"""
+            SELECT {spec.id_column}, 1 - (embedding <=> {embedding}) AS similarity
+            FROM {spec.vector_table}
+            {where}
+            ORDER BY embedding <=> {embedding}
+            LIMIT %(k)s
+        """
+    
+    return f"""
+        SELECT {spec.id_column}, 1 - (embedding <=> {embedding}) AS similarity
+        FROM (
+            SELECT {spec.id_column}, embedding
+            FROM {spec.vector_table}
+            {where}
+            ORDER BY {COMPACT_COLUMN} {settings['distance']} {settings['query'].format(embedding=embedding)}
+            LIMIT %(candidates)s
+        ) candidates
+        ORDER BY embedding <=> {embedding}
+        LIMIT %(k)s
+    """
+
+def search_query(spec, exclude_id=False):
+    """
+    SQL for the k nearest neighbours of a query embedding in an entity's table.
+    
+    Parameters are %(embedding)s (a vector literal or list), %(k)s and, with
+    a compact precision, %(candidates)s: the number of nearest rows by the
+    compact column that are re-ranked at full precision. With exclude_id,
+    %(exclude_id)s is left out of the results. Rows are (id, similarity).
+    """
+    where = f"{spec.id_column} <> %(exclude_id)s" if exclude_id else ''
+    return nearest_query(spec, '%(embedding)s::vector', where) + ';'
+
+def search_params(embedding, k, exclude_id=None, rerank_factor=None):
+    """Parameters for search_query; candidates is the number of rows taken from the index."""
+    rerank_factor = rerank_factor or EMBEDDING_CONFIG['storage']['rerank_factor']
+    candidates = k * rerank_factor if compact_precision() else k
+    return {'embedding': embedding, 'k': k, 'candidates': candidates, 'exclude_id': exclude_id}
@@ -0,0 +1,284 @@
+"""
+Resumable, checkpointed rebuilds.
+
+A rebuild re-encodes every row of an entity type without touching the source
+tables. plan_rebuild splits the id space into ranges of REBUILD_RANGE_SIZE ids,
+recorded in the checkpoint table with the model version. Workers then:
+- claim the lowest unfinished range with FOR UPDATE SKIP LOCKED, so concurrent
+  workers (processes or hosts) never get the same range;
+- stream the range in id order through the embedding pipeline, recording the
+  last id read in the same transaction as each written chunk;
+- mark the range done, and claim the next one.
+
+An interrupted rebuild resumes each range from its recorded last id. A range
+whose worker stopped without releasing it is reclaimed once its claim is older
+than REBUILD_LEASE seconds; every checkpoint renews the claim. Starting a
+rebuild for another model version discards the previous plan.
+
+embed_rows calls the checkpoint with the write cursor and the id of the last
+row read, just before each chunk commits. Rows of the chunk that failed to
+encode are flagged with embedding_needed in that transaction, so the next
+regular run retries them instead of the range passing over them. Any reader
+or writer error makes embed_rows raise, and the range is handed back at its
+last checkpoint instead of being marked done.
+"""
+import os
+import socket
+import time
+from config import EMBEDDING_CONFIG, logger
+from aggregates import refresh_aggregates
+from backends import model_version
+from create_embeddings import embed_rows, stream_rows
+
+def _checkpoint_table():
+    return f"{EMBEDDING_CONFIG['schema']['vector']}.{EMBEDDING_CONFIG['tables']['rebuild_checkpoint']}"
+
+def _plan_key(spec):
+    # Shadow re-embedding keeps its own plan next to a live rebuild
+    return f"{spec.name}_shadow" if spec.shadow else spec.name
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def throttle(rows, rows_per_second):
+    """Yield rows no faster than rows_per_second; 0 or None means unlimited."""
+    if not rows_per_second:
+        yield from rows
+        return
+    
+    start = time.monotonic()
+    for count, row in enumerate(rows):
+        delay = start + count / rows_per_second - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield row
+
+def ensure_checkpoint_table(conn):
+    """Create the rebuild checkpoint table if it does not exist."""
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {_checkpoint_table()} (
+                entity TEXT NOT NULL,
+                model_version TEXT NOT NULL,
+                range_start BIGINT NOT NULL,
+                range_end BIGINT NOT NULL,
+                last_id BIGINT NOT NULL,
+                done BOOLEAN NOT NULL DEFAULT FALSE,
+                claimed_by TEXT,
+                claimed_at TIMESTAMP,
+                PRIMARY KEY (entity, model_version, range_start)
+            );
+        """)
+        conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error creating rebuild checkpoint table: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def plan_rebuild(conn, spec, version=None):
+    """
+    Record the id ranges of an entity type's rebuild, unless one is in progress.
+    
+    An unfinished plan for the same model version is resumed as it is; a
+    finished one, or one for another version, is replaced. Returns the number
+    of ranges left to process.
+    """
+    version = version or model_version()
+    range_size = EMBEDDING_CONFIG['rebuild']['range_size']
+    cursor = conn.cursor()
+    params = {'entity': _plan_key(spec), 'version': version, 'size': range_size}
+    
+    try:
+        # Serialise planners of the same entity type
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"rebuild:{_plan_key(spec)}",))
+        cursor.execute(f"""
+            DELETE FROM {_checkpoint_table()}
+            WHERE entity = %(entity)s AND model_version <> %(version)s;
+        """, params)
+        if cursor.rowcount:
+            logger.info(f"Discarded the {spec.name} rebuild of a previous model version")
+        
+        cursor.execute(f"""
+            SELECT COUNT(*) FILTER (WHERE NOT done), COUNT(*)
+            FROM {_checkpoint_table()}
+            WHERE entity = %(entity)s AND model_version = %(version)s;
+        """, params)
+        remaining, total = cursor.fetchone()
+        
+        if remaining:
+            conn.commit()
+            logger.info(f"Resuming {spec.name} rebuild for {version}: {remaining} of {total} id ranges left")
+            return remaining
+        
+        cursor.execute(f"""
+            DELETE FROM {_checkpoint_table()}
+            WHERE entity = %(entity)s AND model_version = %(version)s;
+        """, params)
+        cursor.execute(f"""
+            INSERT INTO {_checkpoint_table()} (entity, model_version, range_start, range_end, last_id)
+            SELECT %(entity)s, %(version)s, s - 1, LEAST(s + %(size)s - 1, bounds.max_id), s - 1
+            FROM (SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM {spec.source}) bounds,
+                 generate_series(bounds.min_id, bounds.max_id, %(size)s) s;
+        """, params)
+        planned = cursor.rowcount
+        conn.commit()
+        logger.info(f"Planned {spec.name} rebuild for {version} in {planned} id ranges of {range_size} ids")
+        return planned
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error planning {spec.name} rebuild: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def claim_range(conn, spec, version, worker):
+    """
+    Claim the lowest unfinished range of an entity type's rebuild.
+    
+    Returns (range_start, range_end, last_id), or None when every range is
+    done or claimed by a live worker.
+    """
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            UPDATE {_checkpoint_table()}
+            SET claimed_by = %(worker)s, claimed_at = CURRENT_TIMESTAMP
+            WHERE (entity, model_version, range_start) = (
+                SELECT entity, model_version, range_start
+                FROM {_checkpoint_table()}
+                WHERE entity = %(entity)s AND model_version = %(version)s AND NOT done
+                  AND (claimed_by IS NULL OR claimed_at < CURRENT_TIMESTAMP - %(lease)s * INTERVAL '1 second')
+                ORDER BY range_start
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING range_start, range_end, last_id;
+        """, {
+            'worker': worker,
+            'entity': _plan_key(spec),
+            'version': version,
+            'lease': EMBEDDING_CONFIG['rebuild']['lease'],
+        })
+        
+        claimed = cursor.fetchone()
+        conn.commit()
+        return claimed
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error claiming a {spec.name} rebuild range: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def _update_range(cursor, spec, version, range_start, assignments, values):
+    cursor.execute(f"""
+        UPDATE {_checkpoint_table()}
+        SET {assignments}
+        WHERE entity = %(entity)s AND model_version = %(version)s AND range_start = %(range_start)s;
+    """, dict(values, entity=_plan_key(spec), version=version, range_start=range_start))
+
+def rebuild_entity(conn, model, spec, version=None, rows_per_second=None):
+    """
+    Re-encode the ranges of a planned rebuild until none is left to claim.
+    
+    rows_per_second optionally caps the rate rows are read at, so a background
+    rebuild leaves capacity to production. Returns the number of embeddings
+    stored by this worker.
+    """
+    version = version or model_version()
+    query = spec.candidate_query(pending_only=False)
+    return _rebuild_ranges(conn, model, spec, version, _worker_name(), query, rows_per_second)
+
+def _rebuild_ranges(conn, model, spec, version, worker, query, rows_per_second):
+    total = 0
+    
+    while True:
+        claimed = claim_range(conn, spec, version, worker)
+        if claimed is None:
+            break
+        
+        range_start, range_end, last_id = claimed
+        logger.info(f"Rebuilding {spec.name}s in id range ({last_id}, {range_end}]")
+        
+        def checkpoint(cursor, read_id, range_start=range_start):
+            # Committed with the chunk, so a resumed range starts after it
+            _update_range(cursor, spec, version, range_start,
+                          "last_id = GREATEST(last_id, %(last_id)s), claimed_at = CURRENT_TIMESTAMP",
+                          {'last_id': read_id})
+        
+        finished = False
+        try:
+            refresh_aggregates(conn, spec, (last_id, range_end))
+            rows = throttle(stream_rows(conn, query, (last_id, range_end)), rows_per_second)
+            total += embed_rows(conn, model, spec, rows, reencode=True, checkpoint=checkpoint)
+            finished = True
+        
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"{spec.name.capitalize()} rebuild stopped, it resumes from its last checkpoint: {e}")
+            return total
+        
+        finally:
+            cursor = conn.cursor()
+            try:
+                if finished:
+                    _update_range(cursor, spec, version, range_start,
+                                  "last_id = range_end, done = TRUE, claimed_by = NULL",
+                                  {})
+                else:
+                    # Hand the range back; it resumes from its last checkpoint
+                    _update_range(cursor, spec, version, range_start, "claimed_by = NULL", {})
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.warning(f"Could not update the {spec.name} rebuild checkpoint: {e}")
+            finally:
+                cursor.close()
+    
+    logger.info(f"No {spec.name} rebuild ranges left to claim")
+    return total
+
+def reset_rebuild(conn, spec):
+    """Discard every rebuild plan of an entity type, so the next one starts over."""
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"DELETE FROM {_checkpoint_table()} WHERE entity = %s;", (_plan_key(spec),))
+        conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error discarding the {spec.name} rebuild plan: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def rebuild_progress(conn, spec, version=None):
+    """Return (done ranges, total ranges) of an entity type's rebuild."""
+    version = version or model_version()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            SELECT COUNT(*) FILTER (WHERE done), COUNT(*)
+            FROM {_checkpoint_table()}
+            WHERE entity = %s AND model_version = %s;
+        """, (_plan_key(spec), version))
+        progress = cursor.fetchone()
+        conn.commit()
+        return progress
+    
+    finally:
+        cursor.close()
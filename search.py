@@ -0,0 +1,130 @@
+"""
+Batched similarity search.
+
+search takes any number of queries, over any of the entity types, and answers
+them with one model call and one SQL statement: the query embeddings of each
+entity type are unnested from an array parameter and joined LATERAL to that
+type's k-NN query (see quantization.nearest_query), and the per-type lookups
+are combined with UNION ALL. Each hit carries the matching source row, so
+callers get everything they need from a single round trip.
+
+Tables switched in by a cutover record their model version (see shadow.py).
+Searching one of them with another model raises ModelMismatchError instead of
+comparing vectors of two models.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from config import EMBEDDING_CONFIG, logger
+from backends import model_version
+from entities import ENTITIES
+from indexes import configure_search
+from quantization import nearest_query, search_params
+
+@dataclass
+class Query:
+    """A similarity query: a text to encode, or an existing embedding."""
+    entity: str
+    text: Optional[str] = None
+    embedding: Any = None
+    exclude_id: Optional[int] = None  # e.g. the row the embedding was taken from
+
+@dataclass
+class Hit:
+    """A row similar to a query."""
+    id: int
+    similarity: float
+    row: Dict[str, Any]  # the source row, without embedding_needed
+
+@dataclass
+class Result:
+    """The hits of one query, most similar first."""
+    query: Query
+    hits: List[Hit] = field(default_factory=list)
+
+class ModelMismatchError(Exception):
+    """The embeddings of a table were computed by another model than the one encoding the queries."""
+
+def check_model_version(cursor, specs):
+    """
+    Raise ModelMismatchError if a table searched for specs records another
+    model version. The tables stay locked against a switch until the
+    transaction ends, so the search that follows reads the checked tables.
+    """
+    version = model_version()
+    cursor.execute(f"LOCK TABLE {', '.join(spec.vector_table for spec in specs)} IN ACCESS SHARE MODE;")
+    cursor.execute("SELECT t, obj_description(to_regclass(t), 'pg_class') FROM unnest(%s::text[]) AS t;",
+                   ([spec.vector_table for spec in specs],))
+    for table, pinned in cursor.fetchall():
+        if pinned is not None and pinned != version:
+            raise ModelMismatchError(f"{table} holds embeddings of {pinned}, but queries are encoded with "
+                                     f"{version}; restart with that model")
+
+def _entity_query(spec):
+    """One entity type's part of the batched statement, as (position, id, similarity, row) rows."""
+    name = spec.name
+    nearest = nearest_query(spec, 'q.embedding', f"{spec.id_column} IS DISTINCT FROM q.exclude_id")
+    return f"""
+        SELECT q.position, r.{spec.id_column}, r.similarity, to_jsonb(s) - 'embedding_needed'
+        FROM unnest(%({name}_embeddings)s::vector[], %({name}_excludes)s::integer[], %({name}_positions)s::integer[])
+            AS q(embedding, exclude_id, position)
+        CROSS JOIN LATERAL ({nearest}) r
+        JOIN {spec.source} s ON s.id = r.{spec.id_column}
+    """
+
+def search(conn, model, queries, k=10):
+    """
+    Run a batch of similarity queries. Returns one Result per query, in order,
+    with up to k hits ordered by decreasing similarity.
+    """
+    results = [Result(query) for query in queries]
+    if not queries:
+        return results
+    
+    for query in queries:
+        if query.entity not in ENTITIES:
+            raise ValueError(f"Unknown entity type '{query.entity}', expected one of {', '.join(ENTITIES)}")
+    
+    # All texts are encoded in one call
+    embeddings = [query.embedding for query in queries]
+    to_encode = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if to_encode:
+        encoded = model.encode(
+            [queries[i].text for i in to_encode],
+            batch_size=EMBEDDING_CONFIG['batch_size'],
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        for i, embedding in zip(to_encode, encoded):
+            embeddings[i] = embedding
+    
+    params = search_params(None, k)
+    parts = []
+    specs = []
+    for entity, spec in ENTITIES.items():
+        positions = [i for i, query in enumerate(queries) if query.entity == entity]
+        if not positions:
+            continue
+        specs.append(spec)
+        parts.append(_entity_query(spec))
+        params[f"{entity}_embeddings"] = [embeddings[i] for i in positions]
+        params[f"{entity}_excludes"] = [queries[i].exclude_id for i in positions]
+        params[f"{entity}_positions"] = positions
+    
+    cursor = conn.cursor()
+    
+    try:
+        configure_search(cursor, params['candidates'])
+        check_model_version(cursor, specs)
+        cursor.execute(" UNION ALL ".join(parts) + " ORDER BY 1, 3 DESC;", params)
+        for position, entity_id, similarity, row in cursor.fetchall():
+            results[position].hits.append(Hit(entity_id, similarity, row))
+        conn.commit()
+        return results
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Batched similarity search failed: {e}")
+        raise
+    
+    finally:
+        cursor.close()
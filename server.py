@@ -0,0 +1,196 @@
+"""
+Query-time embedding service.
+
+Exposes two HTTP endpoints:
+- POST /embed  {"texts": [...]}                      -> {"embeddings": [[...], ...]}
+- POST /search {"query": "...", "type": "course", "k": 5} -> {"results": [{"id": ..., "similarity": ...}]}
+- GET  /metrics                                      -> Prometheus metrics
+
+Concurrent requests are coalesced into dynamic micro-batches: the first queued
+request opens a batch that closes when it is full or after a small max-wait
+deadline, and the whole batch is encoded with a single model call. Query
+embeddings are kept in an LRU cache.
+"""
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from flask import Flask, Response, jsonify, request
+from config import EMBEDDING_CONFIG, logger
+from create_embeddings import encode_texts
+from entities import ENTITIES
+from indexes import configure_search
+from quantization import search_query, search_params
+from search import ModelMismatchError, check_model_version
+from metrics import METRICS
+from db import init_pool, close_pool, get_connection, release_connection
+
+class LRUCache:
+    """Thread-safe least-recently-used cache of query embeddings."""
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+class MicroBatcher:
+    """Coalesces concurrent encode requests into batched model calls."""
+    
+    def __init__(self, model, max_batch_size, max_wait):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+    
+    def encode(self, texts):
+        """Encode texts as part of the next micro-batch, blocking until done."""
+        future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+    
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            
+            # Collect more requests until the batch is full or the deadline passes
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            METRICS.observe_batch('query', len(texts))
+            try:
+                with METRICS.timer('query', 'encode'):
+                    embeddings = encode_texts(self.model, texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            offset = 0
+            for request_texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+def create_app(model):
+    """Create the Flask app serving /embed and /search."""
+    config = EMBEDDING_CONFIG['server']
+    app = Flask('embedding-service')
+    batcher = MicroBatcher(model, config['max_batch_size'], config['max_wait_ms'] / 1000.0)
+    cache = LRUCache(config['query_cache_size'])
+    # Flask starts a thread per request; searches wait here instead of exhausting the pool
+    search_slots = threading.BoundedSemaphore(config['max_connections'])
+    
+    def embed(texts):
+        """Embed texts, serving repeated queries from the LRU cache."""
+        embeddings = [cache.get(text) for text in texts]
+        misses = [text for text, embedding in zip(texts, embeddings) if embedding is None]
+        METRICS.inc('cache_hits', 'query', len(texts) - len(misses))
+        METRICS.inc('cache_misses', 'query', len(misses))
+        
+        if misses:
+            encoded = dict(zip(misses, batcher.encode(misses)))
+            for text, embedding in encoded.items():
+                cache.put(text, embedding)
+            embeddings = [embedding if embedding is not None else encoded[text]
+                          for text, embedding in zip(texts, embeddings)]
+        
+        return embeddings
+    
+    @app.route('/embed', methods=['POST'])
+    def embed_endpoint():
+        payload = request.get_json(silent=True) or {}
+        texts = payload.get('texts') or ([payload['text']] if 'text' in payload else [])
+        if not texts or not all(isinstance(text, str) for text in texts):
+            return jsonify({'error': "Expected a 'texts' list of strings"}), 400
+        
+        return jsonify({'embeddings': [embedding.tolist() for embedding in embed(texts)]})
+    
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return Response(METRICS.render_prometheus(), mimetype='text/plain; version=0.0.4')
+    
+    @app.route('/search', methods=['POST'])
+    def search_endpoint():
+        payload = request.get_json(silent=True) or {}
+        query = payload.get('query')
+        entity = payload.get('type', 'comment')
+        k = payload.get('k', 5)
+        if not isinstance(query, str) or entity not in ENTITIES:
+            return jsonify({'error': "Expected a 'query' string and a valid 'type'"}), 400
+        max_k = EMBEDDING_CONFIG['server']['max_k']
+        if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= max_k:
+            return jsonify({'error': f"Expected 'k' to be an integer between 1 and {max_k}"}), 400
+        
+        embedding = embed([query])[0]
+        spec = ENTITIES[entity]
+        
+        conn = None
+        cursor = None
+        search_slots.acquire()
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            params = search_params(embedding, k)
+            configure_search(cursor, params['candidates'])
+            check_model_version(cursor, [spec])
+            cursor.execute(search_query(spec), params)
+            results = [{'id': entity_id, 'similarity': similarity} for entity_id, similarity in cursor.fetchall()]
+            conn.commit()
+        except ModelMismatchError as e:
+            conn.rollback()
+            logger.error(f"Search refused for {entity}s: {e}")
+            return jsonify({'error': str(e)}), 503
+        except Exception as e:
+            if conn is not None:
+                conn.rollback()
+            logger.error(f"Search failed for {entity}s: {e}")
+            return jsonify({'error': 'Search failed'}), 500
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if conn is not None:
+                release_connection(conn)
+            search_slots.release()
+        
+        return jsonify({'results': results})
+    
+    return app
+
+def serve(model):
+    """Run the query-time embedding server until interrupted."""
+    config = EMBEDDING_CONFIG['server']
+    init_pool(1, config['max_connections'])
+    
+    try:
+        logger.info(f"Serving /embed and /search on {config['host']}:{config['port']}")
+        create_app(model).run(host=config['host'], port=config['port'], threaded=True)
+    
+    finally:
+        close_pool()
@@ -0,0 +1,342 @@
+"""
+Model changes without mixed search results.
+
+Every embedding row records the model version it was computed with (model
+name, revision and dimension, see backends.model_version). To move to another
+model, the embeddings are computed again into a shadow copy of each vectors
+table while production keeps reading and writing the live one:
+
+1. shadow_embeddings creates <table>_shadow with the live table's columns,
+   keys and foreign keys, and a shadow chunk table referencing it if the
+   entity type has a chunk table. It re-embeds every row into them with the
+   configured model as a checkpointed rebuild (see rebuild.py), at
+   SHADOW_ROWS_PER_SECOND.
+   It then catches up with texts that changed meanwhile and builds the
+   shadow's ANN index.
+2. cutover checks that every shadow is complete and indexed, then swaps them
+   all in, chunk tables included, by renaming the tables and their indexes in
+   one transaction. The former live tables are kept as <table>_previous.
+3. rollback swaps the <table>_previous tables back in the same way.
+
+Each swap flags the rows whose text differs between the two tables, so the
+writers of the new model bring them up to date. A CHECK constraint pins every
+table to its side of the change. The table switched in only accepts embeddings
+of its model, and the table switched out refuses them, so a writer still
+running the other model fails loudly instead of mixing models.
+"""
+from dataclasses import replace
+from config import EMBEDDING_CONFIG, logger
+from entities import ENTITIES
+from aggregates import refresh_aggregates
+from backends import model_version
+from chunking import create_chunk_table
+from create_embeddings import embed_rows, stream_rows
+from indexes import create_indexes
+from quantization import COMPACT_COLUMN, add_compact_column
+from rebuild import plan_rebuild, rebuild_entity, rebuild_progress, reset_rebuild, throttle
+
+PIN_CONSTRAINT = 'model_version_pin'
+
+def _names(entity, table=None):
+    """
+    Schema and unqualified live, shadow and previous names of an entity
+    type's vectors table, or of another of its tables (e.g. 'comment_chunk').
+    """
+    live = EMBEDDING_CONFIG['tables'][table or entity]
+    return EMBEDDING_CONFIG['schema']['vector'], live, f"{live}_shadow", f"{live}_previous"
+
+def _switched_tables(entity):
+    """Tables switched together for an entity type; chunk tables reference the vectors table, so come after it."""
+    tables = [entity]
+    if ENTITIES[entity].chunk_field is not None:
+        tables.append(f"{entity}_chunk")
+    return tables
+
+def _exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+    return cursor.fetchone()[0]
+
+def _table_version(cursor, table):
+    """Model version recorded in a table's comment, or None if the table does not exist."""
+    cursor.execute("SELECT obj_description(to_regclass(%s), 'pg_class'), to_regclass(%s) IS NOT NULL;",
+                   (table, table))
+    comment, exists = cursor.fetchone()
+    return comment if exists else None
+
+def _ann_indexes(cursor, table, valid_only=False):
+    """Names of the HNSW and IVFFlat indexes of a table; valid_only skips interrupted builds."""
+    cursor.execute("""
+        SELECT i.relname FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_am am ON am.oid = i.relam
+        WHERE x.indrelid = %s::regclass AND am.amname IN ('hnsw', 'ivfflat') AND (x.indisvalid OR NOT %s);
+    """, (table, valid_only))
+    return [row[0] for row in cursor.fetchall()]
+
+def _pin(cursor, table, check, version):
+    cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {PIN_CONSTRAINT};")
+    cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {PIN_CONSTRAINT} CHECK ({check}) NOT VALID;",
+                   {'version': version})
+
+def _ensure_shadow_chunks(cursor, entity):
+    """Create the shadow chunk table of an entity type if it has a live one; returns whether it was created."""
+    spec = ENTITIES[entity]
+    shadow = replace(spec, shadow=True)
+    if spec.chunk_field is None or not _exists(cursor, spec.chunk_table) or _exists(cursor, shadow.chunk_table):
+        return False
+    create_chunk_table(cursor, shadow)
+    logger.info(f"Created {shadow.chunk_table}")
+    return True
+
+def ensure_shadow_table(conn, entity, version):
+    """
+    Create the shadow tables of an entity type for a model version, replacing
+    those for another version. Returns whether a new table was created.
+    """
+    schema, live, shadow, _ = _names(entity)
+    cursor = conn.cursor()
+    
+    try:
+        current = _table_version(cursor, f"{schema}.{shadow}")
+        if current == version:
+            # Rows shadowed before the chunk table existed have no chunks yet
+            created = _ensure_shadow_chunks(cursor, entity)
+            conn.commit()
+            return created
+        if current is not None:
+            for table in reversed(_switched_tables(entity)):
+                cursor.execute(f"DROP TABLE IF EXISTS {schema}.{_names(entity, table)[2]};")
+            logger.info(f"Dropped {schema}.{shadow} built for {current}")
+        
+        cursor.execute(f"CREATE TABLE {schema}.{shadow} (LIKE {schema}.{live} INCLUDING ALL);")
+        
+        # The ANN index is built once the shadow is filled
+        for index in _ann_indexes(cursor, f"{schema}.{shadow}"):
+            cursor.execute(f"DROP INDEX {schema}.{index};")
+        
+        # The new model may have another dimension than the live table's
+        cursor.execute(f"ALTER TABLE {schema}.{shadow} DROP COLUMN IF EXISTS {COMPACT_COLUMN};")
+        cursor.execute(f"ALTER TABLE {schema}.{shadow} ALTER COLUMN embedding TYPE vector({EMBEDDING_CONFIG['embedding_dim']});")
+        add_compact_column(cursor, f"{schema}.{shadow}")
+        
+        # Serial columns would share, and later lose, the live table's sequence
+        cursor.execute("""
+            SELECT a.attname FROM pg_attribute a
+            JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+            WHERE a.attrelid = %s::regclass AND pg_get_expr(d.adbin, d.adrelid) LIKE 'nextval(%%';
+        """, (f"{schema}.{shadow}",))
+        for (column,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {schema}.{shadow} ALTER COLUMN {column} DROP DEFAULT;")
+            cursor.execute(f"ALTER TABLE {schema}.{shadow} ALTER COLUMN {column} ADD GENERATED BY DEFAULT AS IDENTITY;")
+        
+        # LIKE does not copy foreign keys
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = %s::regclass AND contype = 'f';
+        """, (f"{schema}.{live}",))
+        for name, definition in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {schema}.{shadow} ADD CONSTRAINT {name} {definition};")
+        
+        _pin(cursor, f"{schema}.{shadow}", "model_version = %(version)s", version)
+        cursor.execute(f"COMMENT ON TABLE {schema}.{shadow} IS %s;", (version,))
+        _ensure_shadow_chunks(cursor, entity)
+        conn.commit()
+        logger.info(f"Created {schema}.{shadow} for {version}")
+        return True
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error creating the {entity} shadow table: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+
+def _stale_condition(spec, live_table):
+    """
+    Rows whose shadow embedding may be out of date: missing, waiting for the
+    live writers, or re-embedded live from another text since it was shadowed.
+    """
+    a = spec.alias
+    return f"""
+        {a}.embedding_needed IS NOT FALSE
+        OR NOT EXISTS (
+            SELECT 1 FROM {spec.vector_table} t
+            LEFT JOIN {live_table} l ON l.{spec.id_column} = t.{spec.id_column}
+            WHERE t.{spec.id_column} = {a}.id AND (l.text_hash IS NULL OR l.text_hash = t.text_hash)
+        )
+    """
+
+def shadow_embeddings(conn, model, entity, rows_per_second=None):
+    """
+    Re-embed every row of an entity type into its shadow table with the configured model.
+    
+    Resumes an interrupted run. Returns the number of embeddings stored.
+    """
+    version = model_version()
+    spec = replace(ENTITIES[entity], shadow=True)
+    if rows_per_second is None:
+        rows_per_second = EMBEDDING_CONFIG['shadow']['rows_per_second']
+    
+    if ensure_shadow_table(conn, entity, version):
+        reset_rebuild(conn, spec)
+    
+    count = 0
+    done, total = rebuild_progress(conn, spec, version)
+    if not total or done < total:
+        plan_rebuild(conn, spec, version)
+        count = rebuild_entity(conn, model, spec, version, rows_per_second)
+        done, total = rebuild_progress(conn, spec, version)
+        if done < total:
+            logger.warning(f"{done} of {total} {entity} shadow ranges are done; run --shadow again to resume")
+            return count
+    
+    # Texts that changed since their range was re-embedded; only these are
+    # streamed and throttled, and their hashes decide which are encoded
+    schema, live, _, _ = _names(entity)
+    refresh_aggregates(conn, spec)
+    query = spec.candidate_query(pending_only=False, where=_stale_condition(spec, f"{schema}.{live}"))
+    count += embed_rows(conn, model, spec, throttle(stream_rows(conn, query), rows_per_second))
+    
+    create_indexes(conn, [entity], suffix='_shadow')
+    logger.info(f"{spec.vector_table} is ready for {version}; run --cutover to switch it in")
+    return count
+
+def _rename(cursor, schema, old, new):
+    """Rename a table and the indexes named after it."""
+    cursor.execute(f"ALTER TABLE {schema}.{old} RENAME TO {new};")
+    cursor.execute("""
+        SELECT i.relname FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass;
+    """, (f"{schema}.{new}",))
+    for (index,) in cursor.fetchall():
+        if index.startswith(old):
+            cursor.execute(f"ALTER INDEX {schema}.{index} RENAME TO {new}{index[len(old):]};")
+
+def _prepare_switch(cursor, entity, suffix):
+    """
+    Lock the live and incoming (suffix '_shadow' or '_previous') tables of an
+    entity type against writers, drop the incoming rows of deleted sources and
+    flag the rows it has other text for. Returns the incoming table's model
+    version and the number of rows flagged.
+    """
+    spec = ENTITIES[entity]
+    schema, live, _, _ = _names(entity)
+    source = f"{schema}.{live}{suffix}"
+    
+    version = _table_version(cursor, source)
+    if not _exists(cursor, source):
+        raise ValueError(f"{source} does not exist")
+    
+    # Chunks would otherwise stay behind with the embeddings they were pooled into
+    tables = []
+    for table in _switched_tables(entity):
+        name = f"{schema}.{_names(entity, table)[1]}"
+        if _exists(cursor, name) and not _exists(cursor, f"{name}{suffix}"):
+            raise ValueError(f"{name}{suffix} does not exist, so the chunks of {name} cannot be switched")
+        tables += [t for t in (name, f"{name}{suffix}") if _exists(cursor, t)]
+    
+    # Writers wait from here on, searches only during the renames
+    cursor.execute(f"LOCK TABLE {', '.join(tables)} IN SHARE ROW EXCLUSIVE MODE;")
+    cursor.execute(f"""
+        DELETE FROM {source} t
+        WHERE NOT EXISTS (SELECT 1 FROM {spec.source} s WHERE s.id = t.{spec.id_column});
+    """)
+    cursor.execute(f"""
+        UPDATE {spec.source} SET embedding_needed = TRUE
+        WHERE embedding_needed IS FALSE AND id IN (
+            SELECT l.{spec.id_column}
+            FROM {schema}.{live} l
+            LEFT JOIN {source} t ON t.{spec.id_column} = l.{spec.id_column}
+            WHERE t.text_hash IS NULL OR (l.text_hash IS NOT NULL AND t.text_hash <> l.text_hash)
+        );
+    """)
+    return version, cursor.rowcount
+
+def _swap(cursor, entity, suffix, version):
+    """Rename an entity type's incoming tables to the live names, and the live ones out of the way."""
+    schema, live, _, _ = _names(entity)
+    tables = [_names(entity, table)[1] for table in _switched_tables(entity)]
+    tables = [name for name in tables if _exists(cursor, f"{schema}.{name}{suffix}")]
+    present = [f"{schema}.{t}" for name in tables for t in (name, f"{name}{suffix}")
+               if _exists(cursor, f"{schema}.{t}")]
+    cursor.execute(f"LOCK TABLE {', '.join(present)} IN ACCESS EXCLUSIVE MODE;")
+    
+    if suffix == '_shadow':
+        # The outgoing table refuses embeddings of the incoming model
+        _pin(cursor, f"{schema}.{live}", "model_version IS DISTINCT FROM %(version)s", version)
+        for name in reversed(tables):
+            cursor.execute(f"DROP TABLE IF EXISTS {schema}.{name}_previous;")
+        for name in tables:
+            if _exists(cursor, f"{schema}.{name}"):
+                _rename(cursor, schema, name, f"{name}_previous")
+            _rename(cursor, schema, f"{name}_shadow", name)
+    else:
+        for name in tables:
+            if _exists(cursor, f"{schema}.{name}"):
+                _rename(cursor, schema, name, f"{name}_swap")
+                _rename(cursor, schema, f"{name}_previous", name)
+                _rename(cursor, schema, f"{name}_swap", f"{name}_previous")
+            else:
+                _rename(cursor, schema, f"{name}_previous", name)
+
+def _switch(conn, entities, suffix):
+    """
+    Swap the live tables of entity types with their shadow or previous tables
+    in one transaction, so searches never see tables of two models.
+    """
+    cursor = conn.cursor()
+    
+    try:
+        prepared = {entity: _prepare_switch(cursor, entity, suffix) for entity in entities}
+        for entity, (version, _) in prepared.items():
+            _swap(cursor, entity, suffix, version)
+        conn.commit()
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error switching {', '.join(entities)} embedding tables, none were switched: {e}")
+        raise
+    
+    finally:
+        cursor.close()
+    
+    for entity, (version, stale) in prepared.items():
+        schema, live, _, _ = _names(entity)
+        logger.info(f"Switched {schema}.{live}{suffix} in as {schema}.{live}"
+                    f"{f' ({version})' if version else ''}; {stale} {entity}s flagged to catch up")
+
+def _check_shadow(conn, entity):
+    """Raise ValueError unless the shadow table of an entity type is complete and indexed."""
+    spec = replace(ENTITIES[entity], shadow=True)
+    schema, _, shadow, _ = _names(entity)
+    cursor = conn.cursor()
+    
+    try:
+        version = _table_version(cursor, f"{schema}.{shadow}")
+        indexed = version is not None and bool(_ann_indexes(cursor, f"{schema}.{shadow}", valid_only=True))
+        conn.commit()
+    finally:
+        cursor.close()
+    
+    if version is None:
+        raise ValueError(f"{schema}.{shadow} does not exist; run --shadow first")
+    done, total = rebuild_progress(conn, spec, version)
+    if not total or done < total:
+        raise ValueError(f"{schema}.{shadow} is not complete ({done} of {total} ranges); run --shadow first")
+    # Switching in an unindexed table would make every search a full scan
+    if EMBEDDING_CONFIG['index']['type'] != 'none' and not indexed:
+        raise ValueError(f"{schema}.{shadow} has no ANN index yet; run --shadow to finish it")
+    return version
+
+def cutover(conn, entities):
+    """Switch the finished shadow tables of entity types in together; the live ones become the previous."""
+    versions = {_check_shadow(conn, entity) for entity in entities}
+    if len(versions) > 1:
+        raise ValueError(f"The shadow tables were built for different models: {', '.join(sorted(versions))}")
+    _switch(conn, entities, '_shadow')
+
+def rollback(conn, entities):
+    """Switch the previous tables of entity types back in together; running it again rolls forward."""
+    _switch(conn, entities, '_previous')
@@ -0,0 +1,200 @@
+"""
+Offline similarity over memory-mapped embedding snapshots.
+
+export_snapshot copies a vectors table into three files in the snapshot
+directory:
+- <entity>.f32: the L2-normalised embeddings as a raw float32 matrix, one row
+  per embedding, opened with np.memmap;
+- <entity>.ids.npy: the source ids of the rows, as int64;
+- <entity>.json: the row count, dimension, model version and export time.
+
+top_k answers many queries against a snapshot with matrix multiplications:
+queries are scored against blocks of rows and only the best k candidates per
+query are kept between blocks, so memory stays bounded by one
+queries x block_rows score matrix whatever the table size. write_neighbors uses
+it to compute the nearest neighbours of every row and writes them back to
+vectors.<entity>_neighbors with COPY into a new table that is swapped in.
+"""
+import io
+import json
+import os
+import time
+import numpy as np
+from config import EMBEDDING_CONFIG, logger
+from backends import model_version
+from entities import ENTITIES
+
+def _paths(directory, entity):
+    base = os.path.join(directory, entity)
+    return f"{base}.f32", f"{base}.ids.npy", f"{base}.json"
+
+def export_snapshot(conn, entity, directory=None):
+    """Write a consistent snapshot of an entity's embeddings. Returns the number of rows."""
+    directory = directory or EMBEDDING_CONFIG['snapshot']['dir']
+    spec = ENTITIES[entity]
+    dim = EMBEDDING_CONFIG['embedding_dim']
+    matrix_path, ids_path, meta_path = _paths(directory, entity)
+    os.makedirs(directory, exist_ok=True)
+    
+    cursor = conn.cursor()
+    # Server-side cursor, so rows are streamed instead of loaded at once
+    rows = conn.cursor(name=f"{entity}_snapshot")
+    rows.itersize = EMBEDDING_CONFIG['fetch_size']
+    
+    try:
+        # The count and the rows must come from the same snapshot
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+        cursor.execute(f"SELECT COUNT(*) FROM {spec.vector_table};")
+        count = cursor.fetchone()[0]
+        
+        matrix = np.memmap(f"{matrix_path}.tmp", dtype=np.float32, mode='w+', shape=(max(count, 1), dim))
+        ids = np.empty(count, dtype=np.int64)
+        rows.execute(f"SELECT {spec.id_column}, embedding FROM {spec.vector_table} ORDER BY {spec.id_column};")
+        for i, (entity_id, embedding) in enumerate(rows):
+            ids[i] = entity_id
+            matrix[i] = embedding
+        norms = np.linalg.norm(matrix[:count], axis=1, keepdims=True)
+        matrix[:count] /= np.maximum(norms, np.finfo(np.float32).tiny)
+        matrix.flush()
+        del matrix
+        conn.commit()
+        
+        np.save(f"{ids_path}.tmp.npy", ids)
+        with open(f"{meta_path}.tmp", 'w') as f:
+            json.dump({
+                'entity': entity,
+                'count': int(count),
+                'dim': dim,
+                'model_version': model_version(),
+                'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }, f, indent=2)
+        
+        # Replace the previous snapshot's files only once the new one is complete
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+        os.replace(f"{ids_path}.tmp.npy", ids_path)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        logger.info(f"Exported {count} {entity} embeddings to {matrix_path}")
+        return count
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error exporting {entity} snapshot: {e}")
+        raise
+    
+    finally:
+        rows.close()
+        cursor.close()
+
+def load_snapshot(entity, directory=None):
+    """Open a snapshot read-only. Returns (ids, matrix); the matrix is memory-mapped."""
+    directory = directory or EMBEDDING_CONFIG['snapshot']['dir']
+    matrix_path, ids_path, meta_path = _paths(directory, entity)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    
+    ids = np.load(ids_path)
+    if not meta['count']:
+        return ids, np.empty((0, meta['dim']), dtype=np.float32)
+    matrix = np.memmap(matrix_path, dtype=np.float32, mode='r', shape=(meta['count'], meta['dim']))
+    return ids, matrix
+
+def top_k(matrix, queries, k, exclude=None, block_rows=None):
+    """
+    Indices and cosine similarities of the k rows of matrix nearest to each query.
+    
+    matrix and queries must be L2-normalised. exclude optionally gives, per
+    query, a row index to leave out (e.g. the query's own row). Returns
+    (indices, similarities), both of shape (len(queries), k), best first.
+    """
+    block_rows = block_rows or EMBEDDING_CONFIG['snapshot']['block_rows']
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(matrix) - (1 if exclude is not None else 0))
+    if k <= 0:
+        return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+    
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+    rows = np.arange(len(queries))
+    
+    for start in range(0, len(matrix), block_rows):
+        block = np.asarray(matrix[start:start + block_rows])
+        scores = queries @ block.T
+        if exclude is not None:
+            local = np.asarray(exclude) - start
+            inside = (local >= 0) & (local < len(block))
+            scores[rows[inside], local[inside]] = -np.inf
+        
+        # Merge the block into the running top k with a partial sort
+        candidate_scores = np.concatenate([best_scores, scores], axis=1)
+        candidate_indices = np.concatenate(
+            [best_indices, np.broadcast_to(np.arange(start, start + len(block)), scores.shape)], axis=1)
+        keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+        best_indices = np.take_along_axis(candidate_indices, keep, axis=1)
+    
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+def _create_neighbors_table(cursor, spec, table):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {spec.id_column} INTEGER NOT NULL,
+            neighbor_id INTEGER NOT NULL,
+            rank SMALLINT NOT NULL,
+            similarity REAL NOT NULL
+        );
+    """)
+
+def write_neighbors(conn, entity, k, directory=None):
+    """
+    Compute the k nearest neighbours of every row of a snapshot and store them.
+    
+    The neighbours are written to a new table, which replaces the current one
+    in a short transaction at the end; readers keep the previous neighbours
+    until then. Returns the number of rows processed.
+    """
+    spec = ENTITIES[entity]
+    query_chunk = EMBEDDING_CONFIG['snapshot']['query_chunk']
+    ids, matrix = load_snapshot(entity, directory)
+    schema, name = spec.neighbors_table.split('.')
+    staging = f"{spec.neighbors_table}_new"
+    cursor = conn.cursor()
+    start_time = time.perf_counter()
+    
+    try:
+        # Left over by an interrupted run
+        cursor.execute(f"DROP TABLE IF EXISTS {staging};")
+        _create_neighbors_table(cursor, spec, staging)
+        
+        for start in range(0, len(matrix), query_chunk):
+            positions = np.arange(start, min(start + query_chunk, len(matrix)))
+            indices, similarities = top_k(matrix, matrix[start:start + query_chunk], k, exclude=positions)
+            
+            buffer = io.StringIO()
+            for query_id, row_indices, row_similarities in zip(ids[positions], indices, similarities):
+                for rank, (index, similarity) in enumerate(zip(row_indices, row_similarities), 1):
+                    buffer.write(f"{query_id}\t{ids[index]}\t{rank}\t{similarity:.6f}\n")
+            buffer.seek(0)
+            cursor.copy_expert(
+                f"COPY {staging} ({spec.id_column}, neighbor_id, rank, similarity) FROM STDIN", buffer)
+            logger.debug(f"Computed neighbours of {positions[-1] + 1}/{len(matrix)} {entity}s")
+        
+        cursor.execute(f"ALTER TABLE {staging} ADD CONSTRAINT {name}_new_pkey PRIMARY KEY ({spec.id_column}, rank);")
+        conn.commit()
+        
+        # Readers only wait for the swap
+        cursor.execute(f"DROP TABLE IF EXISTS {spec.neighbors_table};")
+        cursor.execute(f"ALTER TABLE {staging} RENAME TO {name};")
+        cursor.execute(f"ALTER INDEX {schema}.{name}_new_pkey RENAME TO {name}_pkey;")
+        conn.commit()
+        logger.info(f"Stored {k} nearest neighbours of {len(matrix)} {entity}s in {spec.neighbors_table} "
+                    f"in {time.perf_counter() - start_time:.1f}s")
+        return len(matrix)
+    
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error computing {entity} neighbours: {e}")
+        raise
+    
+    finally:
+        cursor.close()
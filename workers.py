@@ -0,0 +1,179 @@
+"""
+Parallel embedding generation.
+
+Two modes are supported:
+- Multi-process, for CPU-only nodes: pending rows of each entity type are split
+  into id ranges of roughly equal size, and the ranges are processed by a pool
+  of worker processes that each load the model once. In a rebuild, the workers
+  instead claim the checkpointed ranges of the rebuild plan (see rebuild.py).
+- Multi-threaded: the entity types are processed concurrently in one process,
+  sharing the model and a connection pool.
+"""
+import copy
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import EMBEDDING_CONFIG, logger
+from create_embeddings import generate_embeddings
+from rebuild import rebuild_entity
+from entities import ENTITIES
+from metrics import METRICS
+from db import connect, init_pool, close_pool, get_connection, release_connection
+
+# Model loaded once per worker process
+_worker_model = None
+
+def pending_id_ranges(conn, entity, shards):
+    """
+    Split the pending rows of an entity into at most `shards` id ranges.
+    
+    Ranges are (exclusive lower bound, inclusive upper bound) pairs holding roughly
+    the same number of pending rows; None means unbounded.
+    """
+    if shards <= 1:
+        return [(None, None)]
+    
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f"""
+            SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY id)
+            FROM {ENTITIES[entity].source}
+            WHERE embedding_needed IS NOT FALSE;
+        """, ([i / shards for i in range(1, shards)],))
+        
+        cuts = cursor.fetchone()[0]
+        conn.commit()
+        if cuts is None:
+            # Nothing pending
+            return []
+        
+        bounds = [None] + sorted(set(cuts)) + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+    
+    finally:
+        cursor.close()
+
+def _init_worker(threads):
+    """Load the model once per worker process."""
+    global _worker_model
+    
+    # Give each worker its share of the cores instead of letting every process
+    # start one thread per core; OpenMP reads its limit when the backend is
+    # first loaded, so it is set before torch or ONNX Runtime is imported
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    
+    from backends import load_model
+    _worker_model = load_model()
+    logger.info(f"Worker {os.getpid()} loaded model {EMBEDDING_CONFIG['model_name']}")
+
+def _run_shard(task):
+    """Generate embeddings for one id range of one entity type, or claim rebuild ranges."""
+    entity, id_range, rebuild = task
+    conn = connect()
+    # Metrics of this shard only; the parent merges them
+    METRICS.reset()
+    
+    try:
+        if rebuild:
+            logger.info(f"Worker {os.getpid()} rebuilding {entity}s")
+            count = rebuild_entity(conn, _worker_model, ENTITIES[entity])
+        else:
+            logger.info(f"Worker {os.getpid()} processing {entity}s in id range {id_range}")
+            count = generate_embeddings(conn, _worker_model, ENTITIES[entity], id_range)
+        return entity, count, METRICS.snapshot()
+    
+    finally:
+        conn.close()
+
+def run_sharded(conn, entities, workers, rebuild=False):
+    """
+    Generate embeddings for the given entity types with a pool of worker processes.
+    
+    With rebuild, every worker works through the planned rebuild of each entity
+    type. Returns a dict of processed counts per entity type.
+    """
+    tasks = []
+    for entity in entities:
+        if rebuild:
+            tasks.extend((entity, None, True) for _ in range(workers))
+            continue
+        ranges = pending_id_ranges(conn, entity, workers)
+        logger.info(f"Split pending {entity}s into {len(ranges)} id ranges")
+        tasks.extend((entity, id_range, False) for id_range in ranges)
+    
+    counts = {entity: 0 for entity in entities}
+    if not tasks:
+        return counts
+    
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # Spawn rather than fork so workers do not inherit torch's thread state
+    context = multiprocessing.get_context('spawn')
+    
+    with context.Pool(processes=workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        for entity, count, snapshot in pool.imap_unordered(_run_shard, tasks):
+            counts[entity] += count
+            METRICS.merge(snapshot)
+    
+    return counts
+
+class SharedEncoder:
+    """Thread-safe wrapper around a model shared by concurrent generators."""
+    
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+    
+    def encode(self, *args, **kwargs):
+        # One inference at a time; torch already spreads each call across cores
+        with self._lock:
+            return self.model.encode(*args, **kwargs)
+    
+    def tokenizer(self, *args, **kwargs):
+        # Fast tokenizers refuse concurrent calls from several threads
+        with self._lock:
+            return self.model.tokenizer(*args, **kwargs)
+    
+    def copy_tokenizer(self):
+        # Private tokenizer for another thread, copied while no encode is running
+        with self._lock:
+            return copy.deepcopy(self.model.tokenizer)
+    
+    def __getattr__(self, name):
+        # Expose max_seq_length and other model attributes
+        return getattr(self.model, name)
+
+def _run_entity(entity, encoder, rebuild):
+    """Generate embeddings for one entity type on a pooled connection."""
+    conn = get_connection()
+    
+    try:
+        if rebuild:
+            return rebuild_entity(conn, encoder, ENTITIES[entity])
+        return generate_embeddings(conn, encoder, ENTITIES[entity])
+    
+    finally:
+        release_connection(conn)
+
+def run_parallel(entities, model, rebuild=False):
+    """
+    Generate embeddings for the given entity types concurrently.
+    
+    Each generator runs in its own thread; generators share the model through a
+    SharedEncoder and take their reader and writer connections from a
+    ThreadedConnectionPool. Returns a dict of processed counts per entity type.
+    """
+    encoder = SharedEncoder(model)
+    # Every generator holds a reader and a writer connection
+    init_pool(1, 2 * len(entities))
+    
+    try:
+        with ThreadPoolExecutor(max_workers=len(entities), thread_name_prefix='generator') as executor:
+            futures = {entity: executor.submit(_run_entity, entity, encoder, rebuild) for entity in entities}
+            return {entity: future.result() for entity, future in futures.items()}
+    
+    finally:
+        close_pool()